@@ -1,11 +1,143 @@
-import time
+import os, json
+import hashlib
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from chain.cache import TemplateCache
+from chain.imageindex import build_blueprint_index
 from chain.knowledgebase import KnowledgeBaseTemplateChain
+from chain.ratelimit import get_rate_limiter
 from chain.retriever import DocRetrieverManager
-from parse import make_outerjoin_df, get_features_from_df
+from parse import get_features_from_workbook
 from utils import open_img
 
+def load_manifest(manifest_path:str) -> dict:
+    if not os.path.exists(manifest_path):
+        return {}
+    with open(manifest_path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+def save_manifest(manifest:dict, manifest_path:str):
+    manifest_dir = os.path.dirname(manifest_path)
+    if manifest_dir:
+        os.makedirs(manifest_dir, exist_ok=True)
+    with open(manifest_path, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, ensure_ascii=False)
+
+def hash_file(path:str) -> str:
+    with open(path, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+def get_row_ids(doc_retriever_manager:DocRetrieverManager, features_list:list) -> list:
+    # Same id insert_dict assigns: rows share the template's ori_features (first row).
+    ori_features = json.dumps(features_list[0], ensure_ascii=False)
+    return [
+        doc_retriever_manager.make_id(features["part_type"], features["classification"], ori_features)
+        for features in features_list
+    ]
+
+def hash_row(features:dict) -> str:
+    return hashlib.sha256(json.dumps(features, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+def get_manifest_rows(entry:dict) -> dict:
+    rows = entry.get("rows", {})
+    # Older manifests kept a plain id list without content hashes.
+    return rows if isinstance(rows, dict) else {}
+
+def select_pending(
+    doc_retriever_manager:DocRetrieverManager,
+    features_per_bp:dict,
+    bp_dir:str,
+    manifest:dict,
+):
+    """Split blueprints into changed or missing rows and images to regenerate.
+
+    A row is pending when its id is missing from the collection or its content
+    hash differs from the manifest. A changed blueprint image makes every row
+    of that blueprint pending and forces a new template. Templates themselves
+    come from the TemplateCache, which rebuilds metadata from the current rows.
+    """
+    pending_per_bp, regenerate = {}, set()
+    for bp_name, features_list in features_per_bp.items():
+        bp_path = os.path.join(bp_dir, bp_name + ".jpg")
+        image_hash = hash_file(bp_path)
+        row_ids = get_row_ids(doc_retriever_manager, features_list)
+        entry = manifest.get(bp_name, {})
+
+        if entry and entry.get("image") != image_hash:
+            pending_per_bp[bp_name] = features_list
+            regenerate.add(bp_name)
+            continue
+
+        known_rows = get_manifest_rows(entry)
+        existing_ids = doc_retriever_manager.get_existing_ids(row_ids)
+        pending = [
+            features for features, row_id in zip(features_list, row_ids)
+            if row_id not in existing_ids or known_rows.get(row_id) != hash_row(features)
+        ]
+        if len(pending) > 0:
+            pending_per_bp[bp_name] = pending
+    return pending_per_bp, regenerate
+
+def get_stale_ids(
+    doc_retriever_manager:DocRetrieverManager,
+    features_per_bp:dict,
+    manifest:dict,
+) -> list:
+    """Ids recorded in the manifest that no longer belong to any row of the sheet."""
+    current_ids = set()
+    for features_list in features_per_bp.values():
+        current_ids.update(get_row_ids(doc_retriever_manager, features_list))
+    return [
+        row_id for entry in manifest.values() for row_id in get_manifest_rows(entry)
+        if row_id not in current_ids
+    ]
+
+def update_manifest(
+    manifest:dict,
+    doc_retriever_manager:DocRetrieverManager,
+    bp_name:str,
+    bp_path:str,
+    features_list:list,
+    failed_ids:list = [],
+):
+    # Rows that failed to insert get no hash, so the next incremental run retries them.
+    failed_ids = set(failed_ids)
+    row_ids = get_row_ids(doc_retriever_manager, features_list)
+    manifest[bp_name] = {
+        "image": hash_file(bp_path),
+        "rows": {
+            row_id: hash_row(features)
+            for row_id, features in zip(row_ids, features_list)
+            if row_id not in failed_ids
+        },
+    }
+
+def build_documents(
+    kb_template_chain:KnowledgeBaseTemplateChain,
+    doc_retriever_manager:DocRetrieverManager,
+    bp_path:str,
+    features_list:list,
+    template_features:dict,
+    retry_count:int = 3,
+    force_regenerate:bool = False,
+):
+    """Generate (or load from the template cache) a blueprint template and fill every row into it."""
+    template = kb_template_chain.invoke(bp_path, template_features, force_regenerate=force_regenerate)
+
+    for _ in range(retry_count):
+        try:
+            formed_features_list = doc_retriever_manager.insert_feature_list_into_template(
+                    features_list=features_list,
+                    template=template,
+                    insert_mode="safe",
+                    check_template_matched=False
+                )
+            return template, formed_features_list
+        except ValueError as e:
+            print(f"Wrong format {os.path.basename(bp_path)} template regenerate {e}---")
+            template = kb_template_chain.invoke(bp_path, template_features, force_regenerate=True)
+    raise ValueError(f"Template for {bp_path} does not match its features.")
+
 if __name__ == "__main__":
-    import os
     from dotenv import load_dotenv
 
     load_dotenv()
@@ -14,54 +146,97 @@ if __name__ == "__main__":
     data_fn = os.environ.get("DATA_PATH")
     bp_dir = os.environ.get("BLUEPRINT_DIR")
     retry_count = int(os.environ.get("RETRY_COUNT"))
+    ingest_mode = os.environ.get("INGEST_MODE", "full")
+    manifest_path = os.environ.get("MANIFEST_PATH", "./chroma/ingest_manifest.json")
+    template_workers = int(os.environ.get("TEMPLATE_WORKERS", 4))
+    rate_limit_rpm = float(os.environ.get("RATE_LIMIT_RPM", 12))
+    rate_limit_burst = int(os.environ.get("RATE_LIMIT_BURST", 1))
+    insert_batch_size = int(os.environ.get("INSERT_BATCH_SIZE", 100))
+    template_cache_path = os.environ.get("TEMPLATE_CACHE_PATH", "./chroma/template_cache.sqlite")
+    force_regenerate = os.environ.get("TEMPLATE_FORCE_REGENERATE", "false").lower() == "true"
 
     print("Load datas---")
-    outerjoin_df = make_outerjoin_df(data_fn)
-    features_per_bp = get_features_from_df(outerjoin_df, mode="all")
+    features_per_bp = get_features_from_workbook(
+        data_fn, mode="all", cache_dir=os.environ.get("WORKBOOK_CACHE_DIR") or None
+    )
 
     print("Load model chain---")
     kb_template_chain = KnowledgeBaseTemplateChain(
-        llm_type='google', 
-        retry_count=retry_count
+        llm_type='google',
+        retry_count=retry_count,
+        rate_limiter=get_rate_limiter("google", rate_limit_rpm, rate_limit_burst),
+        template_cache=TemplateCache(template_cache_path)
     )
 
     print("Load retriever---")
     doc_retriever_manager = DocRetrieverManager(
-        collection_name="knowledgebase", 
+        collection_name="knowledgebase",
         persist_directory="./chroma"
     )
-    
-    bp_kbtemplate_map = {}
-    for bp_name, features_list in features_per_bp.items():
-        bp_path = os.path.join(bp_dir, bp_name + ".jpg")
 
-        kb_template = kb_template_chain.invoke(bp_path, features_list[0])
-        bp_kbtemplate_map[bp_name] = kb_template
+    manifest = load_manifest(manifest_path)
+    all_features_per_bp = features_per_bp
+    regenerate = set()
+    if ingest_mode == "incremental":
+        features_per_bp, regenerate = select_pending(
+            doc_retriever_manager, all_features_per_bp, bp_dir, manifest
+        )
+        print(f"Incremental mode: {len(features_per_bp)}/{len(all_features_per_bp)} blueprints changed---")
 
-        print(f"Template for {bp_name} generated---")
-        time.sleep(5)
+    # Rows removed from the sheet (or re-keyed by an edited first row) leave the collection.
+    stale_ids = get_stale_ids(doc_retriever_manager, all_features_per_bp, manifest)
+    if len(stale_ids) > 0:
+        print(f"Delete {len(stale_ids)} stale rows---")
+        doc_retriever_manager.remove_documents(stale_ids)
+    for bp_name in [bp_name for bp_name in manifest if bp_name not in all_features_per_bp]:
+        del manifest[bp_name]
+    save_manifest(manifest, manifest_path)
 
-    for bp_name, features_list in features_per_bp.items():
+    # LLM calls run concurrently under the shared rate limiter; Chroma writes stay on this thread.
+    with ThreadPoolExecutor(max_workers=template_workers) as executor:
+        futures = {}
+        for bp_name, features_list in features_per_bp.items():
+            bp_path = os.path.join(bp_dir, bp_name + ".jpg")
+            future = executor.submit(
+                build_documents,
+                kb_template_chain,
+                doc_retriever_manager,
+                bp_path,
+                features_list,
+                all_features_per_bp[bp_name][0],
+                retry_count,
+                force_regenerate or bp_name in regenerate,
+            )
+            futures[future] = (bp_name, bp_path)
 
-        for _ in range(retry_count):
+        failed = []
+        for future in as_completed(futures):
+            bp_name, bp_path = futures[future]
             try:
-                formed_features_list = doc_retriever_manager.insert_feature_list_into_template(
-                        features_list=features_list,
-                        template=bp_kbtemplate_map[bp_name],
-                        insert_mode="safe",
-                        check_template_matched=False
-                    )
-                print(f"Make docs for {bp_name} template---")
-                break
-            except ValueError as e:
-                bp_path = os.path.join(bp_dir, bp_name + ".jpg")
-                
-                kb_template = kb_template_chain.invoke(bp_path, features_list[0])
-                bp_kbtemplate_map[bp_name] = kb_template
-                
-                print(f"Wrong format {bp_name} template regenerate {e}---")
-
-        print(f"Insert {bp_name} to DB---")
-        doc_retriever_manager.insert_dict(formed_features_list, check_is_kb=True)
+                _, formed_features_list = future.result()
+            except Exception as e:
+                print(f"Failed {bp_name} cause '{e}'---")
+                failed.append(bp_name)
+                continue
+
+            print(f"Insert {bp_name} to DB---")
+            insert_stats = doc_retriever_manager.insert_dict_bulk(
+                formed_features_list, batch_size=insert_batch_size, check_is_kb=True
+            )
+            if len(insert_stats["failed_ids"]) > 0:
+                # Missing rows are picked up again by the next incremental run.
+                print(f"Insert {bp_name}: {insert_stats['inserted']} rows, {len(insert_stats['failed_ids'])} failed---")
+
+            update_manifest(
+                manifest, doc_retriever_manager, bp_name, bp_path,
+                all_features_per_bp[bp_name], insert_stats["failed_ids"]
+            )
+            save_manifest(manifest, manifest_path)
+
+    if failed:
+        print(f"Failed blueprints: {failed}")
 
+    # Uploaded images that match a known blueprint are resolved locally at query time.
+    print("Build blueprint image index---")
+    build_blueprint_index(bp_dir, os.environ.get("BLUEPRINT_INDEX_PATH", "./chroma/blueprint_index.npz"))
     print("All process is done.")
@@ -61,7 +61,10 @@ else:
 if "chatmanager" not in st.session_state and len(os.environ.get("GOOGLE_API_KEY", "")) >= 30:
     st.session_state.chatmanager = ChatManager(
         llm_type="google", 
-        retriver_doc_num=10
+        retriver_doc_num=10,
+        fallback_llm_type=os.getenv("FALLBACK_LLM_TYPE") or None,
+        fallback_model_name=os.getenv("FALLBACK_MODEL_NAME") or None,
+        image_index_path=os.getenv("BLUEPRINT_INDEX_PATH", "./chroma/blueprint_index.npz"),
     )
 
 # chat interface
@@ -108,8 +111,8 @@ with chat_column:
                     response = chat_container.write_stream(stream)
                 context_data_ids = st.session_state.chatmanager.get_context(st.session_state.session_id)
                 st.session_state.messages.append({"role": "assistant", "content": response})
-            except:
-                error_modal("Somethig is wrong. Try again later.")
+            except Exception as e:
+                error_modal(f"Answer generation failed after retries ({type(e).__name__}: {e}). Try again later.")
 
 # data interface
 with data_column:
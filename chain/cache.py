@@ -0,0 +1,130 @@
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Any, List, Optional
+
+import numpy as np
+
+class SemanticAnswerCache:
+    """Answer cache keyed by question embedding similarity, retrieved ids and collection version.
+
+    A hit needs cosine similarity >= `threshold` to a cached standalone question,
+    the exact same retrieved document ids and the same collection version, so
+    a changed knowledge base never serves stale answers.
+    """
+
+    def __init__(self, max_entries:int = 512, ttl_seconds:float = 3600, threshold:float = 0.95):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.threshold = threshold
+        self._entries = OrderedDict()  # key -> (vector, created_at, (doc_ids, version), payload)
+        self._next_key = 0
+        self._lock = threading.Lock()
+
+    def _normalize(self, vector:List[float]):
+        vector = np.asarray(vector, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm > 0 else vector
+
+    def _group(self, doc_ids:List[str], version:Any):
+        return (frozenset(doc_ids), version)
+
+    def _expire(self):
+        if self.ttl_seconds is None:
+            return
+        deadline = time.time() - self.ttl_seconds
+        for key in [key for key, entry in self._entries.items() if entry[1] < deadline]:
+            del self._entries[key]
+
+    def get(self, vector:List[float], doc_ids:List[str], version:Any) -> Optional[dict]:
+        vector = self._normalize(vector)
+        group = self._group(doc_ids, version)
+        with self._lock:
+            self._expire()
+            best_key, best_score = None, self.threshold
+            for key, (cur_vector, _, cur_group, _) in self._entries.items():
+                if cur_group != group:
+                    continue
+                score = float(np.dot(vector, cur_vector))
+                if score >= best_score:
+                    best_key, best_score = key, score
+            if best_key is None:
+                return None
+            self._entries.move_to_end(best_key)
+            return self._entries[best_key][3]
+
+    def put(self, vector:List[float], doc_ids:List[str], version:Any, answer:str, context_ids:List[str]):
+        vector = self._normalize(vector)
+        group = self._group(doc_ids, version)
+        with self._lock:
+            self._entries[self._next_key] = (
+                vector, time.time(), group, {"answer": answer, "context_ids": context_ids}
+            )
+            self._next_key += 1
+            self._expire()
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, version:Any = None):
+        """Drop every entry, or only entries built against an older collection version."""
+        with self._lock:
+            if version is None:
+                self._entries.clear()
+                return
+            for key in [key for key, entry in self._entries.items() if entry[2][1] != version]:
+                del self._entries[key]
+
+class TemplateCache:
+    """Persistent store of generated `dimension_details`, keyed by blueprint image and column set.
+
+    The key is the SHA-256 of the image content plus part_type, classification
+    and the sorted feature keys, so a spreadsheet revision that only changes
+    values reuses the template while a new image or new columns regenerate it.
+    """
+
+    def __init__(self, path:str):
+        path_dir = os.path.dirname(path)
+        if path_dir:
+            os.makedirs(path_dir, exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS templates ("
+            "key TEXT PRIMARY KEY, image_hash TEXT NOT NULL, dimension_details TEXT NOT NULL, created_at REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_image_hash ON templates (image_hash)")
+        self._conn.commit()
+        self._lock = threading.Lock()
+
+    def make_key(self, image_hash:str, features:dict) -> str:
+        feature_keys = sorted(key for key in features if key not in ("part_type", "classification"))
+        raw = json.dumps(
+            [image_hash, str(features.get("part_type")), str(features.get("classification")), feature_keys],
+            ensure_ascii=False
+        )
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    def get(self, key:str) -> Optional[List[dict]]:
+        with self._lock:
+            row = self._conn.execute("SELECT dimension_details FROM templates WHERE key = ?", (key,)).fetchone()
+        return json.loads(row[0]) if row is not None else None
+
+    def put(self, key:str, image_hash:str, dimension_details:List[dict]):
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO templates (key, image_hash, dimension_details, created_at) VALUES (?, ?, ?, ?)",
+                (key, image_hash, json.dumps(dimension_details, ensure_ascii=False), time.time())
+            )
+            self._conn.commit()
+
+    def invalidate(self, image_hash:str = None):
+        """Drop every template, or only the ones generated from one image."""
+        with self._lock:
+            if image_hash is None:
+                self._conn.execute("DELETE FROM templates")
+            else:
+                self._conn.execute("DELETE FROM templates WHERE image_hash = ?", (image_hash,))
+            self._conn.commit()
@@ -1,27 +1,46 @@
-from typing import Literal, Generator, List
+import os
+import re
+import base64
+from io import BytesIO
+from operator import itemgetter
+from typing import Literal, Generator, AsyncGenerator, List
 
+from PIL import Image
 from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
-from langchain.chains.combine_documents import create_stuff_documents_chain
-from langchain.chains.history_aware_retriever import create_history_aware_retriever
-from langchain.chains import create_retrieval_chain
 from langchain_core.documents import Document
+from langchain_core.output_parsers import StrOutputParser
+from langchain_core.runnables import RunnableBranch, RunnableLambda, RunnablePassthrough
+from langchain_core.runnables.config import run_in_executor
 
-from chain.llm import SimpleLLM
+from chain.cache import SemanticAnswerCache
+from chain.llm import ResilientStream, SimpleLLM
+from chain.packing import ContextPacker
 from chain.retriever import DocRetrieverManager
-from chain.history import RunnableWithMessageHistory, get_session_history
+from chain.imageindex import BlueprintImageIndex
+from chain.history import RunnableWithMessageHistory, get_session_history, get_session_store
 from chain.prompt import (
     CONTEXT_SYSTEM_PROMPT,
     QUERY_SYSTEM_PROMPT,
 )
+from utils import shrink_b64_image
 
 class ChatManager:
     llm = None
     retriever_manager = None
     retriever = None
-    context_prompt_template = None
-    query_prompt_template = None
-    chain = None
-    context_store = {}
+    chains = None
+
+    CHAIN_MODES = ("text", "multimodal")
+
+    # Words that point back into the conversation; questions without them are treated as standalone.
+    BACK_REFERENCE_PATTERN = re.compile(
+        r"\b(it|its|they|them|their|those|these|this one|that one|the same|same one|"
+        r"the (previous|above|former|latter|first|second|last)( ones?)?|another one|one more|instead|"
+        r"what about|how about)\b"
+        r"|(그거|그것|이거|이것|저거|저것|위의 것|이전 것|앞의 것|앞에서|위에서|방금|그중|그 중)",
+        re.IGNORECASE
+    )
+    MIN_STANDALONE_WORDS = 4
 
     def __init__(
         self,
@@ -30,95 +49,213 @@ class ChatManager:
         retry_count:int = 3,
         retriver_doc_num:int = 10,
         score_threshold:float = 0.6,
+        use_range_index:bool = True,
+        fallback_llm_type:Literal["google", "openai", "anthropic"] = None,
+        fallback_model_name:str = None,
+        routing:bool = False,
+        hedge:bool = False,
+        rewrite_model_name:str = None,
+        use_answer_cache:bool = True,
+        context_token_budget:int = 1500,
+        search_type:Literal["hybrid", "similarity_score_threshold"] = "hybrid",
+        image_index_path:str = "./chroma/blueprint_index.npz",
     ) -> None:
         
+        self.use_range_index = use_range_index
+        self.search_type = search_type
+        fallback_llm = None
+        if fallback_llm_type is not None:
+            fallback_llm = SimpleLLM(
+                llm_type=fallback_llm_type,
+                model_name=fallback_model_name,
+                retry_count=retry_count
+            )
         self.llm = SimpleLLM(
             llm_type=llm_type, 
             model_name=model_name, 
-            retry_count=retry_count
+            retry_count=retry_count,
+            fallback=fallback_llm,
+            routing=routing,
+            hedge=hedge
         )
+        # Question rewriting is a small task; it may run on a faster model than the answer.
+        self.rewrite_llm = self.llm
+        if rewrite_model_name is not None:
+            self.rewrite_llm = SimpleLLM(
+                llm_type=llm_type,
+                model_name=rewrite_model_name,
+                retry_count=retry_count
+            )
 
         self.retriever_manager = DocRetrieverManager(
             collection_name="knowledgebase", 
             persist_directory="./chroma"
         )
+        self.answer_cache = SemanticAnswerCache() if use_answer_cache else None
+        self.image_index = None
+        if image_index_path is not None and os.path.exists(image_index_path):
+            self.image_index = BlueprintImageIndex.load(image_index_path)
+        self.context_packer = ContextPacker(max_tokens=context_token_budget)
         self.set_retriever(retriver_doc_num, score_threshold)
-        self.set_prompt_template(mode="text")
         self.set_chain()
 
-    def set_prompt_template(self, mode:Literal["text", "multimodal"]="text"):
+    def make_prompt_template(self, mode:Literal["text", "multimodal"]="text"):
         if mode == "text":
-            self.context_prompt_template = ChatPromptTemplate.from_messages(
-                [
-                    ("system", CONTEXT_SYSTEM_PROMPT),
-                    MessagesPlaceholder("chat_history"),
-                    ("human", "{input}")
-                ]
-            )
-
-            self.query_prompt_template = ChatPromptTemplate.from_messages(
-                [
-                    ("system", QUERY_SYSTEM_PROMPT),
-                    MessagesPlaceholder("chat_history"),
-                    ("human", "{input}"),
-                ]
-            )
+            human_message = ("human", "{input}")
         elif mode == "multimodal":
-            self.context_prompt_template = ChatPromptTemplate.from_messages(
+            human_message = ("human",
                 [
-                    ("system", CONTEXT_SYSTEM_PROMPT),
-                    MessagesPlaceholder("chat_history"),
-                    ("human",
-                    [
-                        {"type": "image_url", "image_url": {"url": "data:image/jpeg;base64,{base64_image}"}},
-                        {"type": "text", "text": "{input}"},
-                    ]
-                    )
+                    {"type": "image_url", "image_url": {"url": "data:image/jpeg;base64,{base64_image}"}},
+                    {"type": "text", "text": "{input}"},
                 ]
             )
+        else:
+            raise ValueError(f"Unknown prompt mode '{mode}'.")
 
-            self.query_prompt_template = ChatPromptTemplate.from_messages(
-                [
-                    ("system", QUERY_SYSTEM_PROMPT),
-                    MessagesPlaceholder("chat_history"),
-                    ("human",
-                    [
-                        {"type": "image_url", "image_url": {"url": "data:image/jpeg;base64,{base64_image}"}},
-                        {"type": "text", "text": "{input}"},
-                    ]
-                    )
-                ]
-            )
+        context_prompt_template = ChatPromptTemplate.from_messages(
+            [
+                ("system", CONTEXT_SYSTEM_PROMPT),
+                MessagesPlaceholder("chat_history"),
+                human_message,
+            ]
+        )
+
+        query_prompt_template = ChatPromptTemplate.from_messages(
+            [
+                ("system", QUERY_SYSTEM_PROMPT),
+                MessagesPlaceholder("chat_history"),
+                human_message,
+            ]
+        )
+        return context_prompt_template, query_prompt_template
 
     def set_retriever(self, retriver_doc_num:int = 10, score_threshold:float = 0.6):
         self.retriever = self.retriever_manager.as_retriever(
-            search_type="similarity_score_threshold",
+            use_range_index=self.use_range_index,
+            use_family_filter=True,
+            search_type=self.search_type,
             search_kwargs={'k':retriver_doc_num, 'score_threshold': score_threshold}
         )
     
-    def set_chain(self):
+    def needs_rewrite(self, inputs:dict) -> bool:
+        if not inputs.get("chat_history"):
+            return False
+        text = inputs["input"]
+        if len(text.split()) < self.MIN_STANDALONE_WORDS:
+            return True
+        return self.BACK_REFERENCE_PATTERN.search(text) is not None
 
-        history_aware_retriever = create_history_aware_retriever(
-            self.llm, self.retriever, self.context_prompt_template
-        )
+    def make_standalone_question(self, context_prompt_template:ChatPromptTemplate):
+        rewrite_chain = context_prompt_template | self.rewrite_llm | StrOutputParser()
+        # Retrieval needs the whole question anyway; invoking keeps stream restarts to the answer.
+        rewrite_chain = RunnableLambda(rewrite_chain.invoke, afunc=rewrite_chain.ainvoke)
+        return RunnableBranch(
+            (self.needs_rewrite, rewrite_chain),
+            itemgetter("input"),
+        ).with_config(run_name="standalone_question")
+
+    def _get_doc_ids(self, context:List[Document]):
+        return [doc.metadata["id"] for doc in context if "id" in doc.metadata]
+
+    def _get_cache_key(self, inputs:dict):
+        # Image questions are not cached: the question text alone does not describe them.
+        if self.answer_cache is None or "base64_image" in inputs:
+            return None
+        vector = self.retriever_manager.embeddings.embed_query(inputs["standalone"])
+        return vector, self._get_doc_ids(inputs["context"]), self.retriever_manager.get_collection_version()
+
+    def lookup_answer(self, inputs:dict):
+        cache_key = self._get_cache_key(inputs)
+        if cache_key is None:
+            return None
+        self.answer_cache.invalidate(version=cache_key[2])
+        cached = self.answer_cache.get(*cache_key)
+        return cached["answer"] if cached is not None else None
+
+    def remember_answer(self, inputs:dict, output:dict):
+        if output.get("cached_answer") is not None:
+            return
+        cache_key = self._get_cache_key({**inputs, **output})
+        if cache_key is not None:
+            self.answer_cache.put(*cache_key, answer=output["answer"], context_ids=cache_key[1])
+
+    def add_blueprint_hint(self, inputs:dict):
+        # Applied inside the history wrapper, so the stored human message stays the user's own text.
+        if not inputs.get("blueprint"):
+            return inputs["input"]
+        return f"{inputs['input']}\n{inputs['blueprint']}"
+
+    def make_retrieval_chain(self, context_prompt_template:ChatPromptTemplate, qa_chain):
+        return (
+            RunnablePassthrough.assign(input=self.add_blueprint_hint)
+            .assign(standalone=self.make_standalone_question(context_prompt_template))
+            .assign(context=(itemgetter("standalone") | self.retriever).with_config(run_name="retrieve_documents"))
+            .assign(cached_answer=self.lookup_answer)
+            .assign(answer=RunnableBranch(
+                (lambda x: x["cached_answer"] is not None, itemgetter("cached_answer")),
+                qa_chain,
+            ))
+        ).with_config(run_name="retrieval_chain")
 
-        qa_chain = create_stuff_documents_chain(self.llm, self.query_prompt_template)
+    def make_chain(self, mode:Literal["text", "multimodal"]="text"):
+        context_prompt_template, query_prompt_template = self.make_prompt_template(mode=mode)
 
-        self.chain = RunnableWithMessageHistory(
-            create_retrieval_chain(history_aware_retriever, qa_chain),
+        # Only the prompt sees the packed table; the output keeps the retrieved Documents.
+        qa_chain = (
+            RunnablePassthrough.assign(context=lambda x: self.context_packer.pack(x["context"]))
+            | query_prompt_template
+            | self.llm
+            | StrOutputParser()
+        ).with_config(run_name="stuff_documents_chain")
+
+        return RunnableWithMessageHistory(
+            self.make_retrieval_chain(context_prompt_template, qa_chain),
             get_session_history,
             input_messages_key="input",
             history_messages_key="chat_history",
             output_messages_key="answer",
         )
+
+    def set_chain(self):
+        # Build every mode once; requests only pick from this registry.
+        self.chains = {mode: self.make_chain(mode=mode) for mode in self.CHAIN_MODES}
+
+    def get_chain(self, mode:Literal["text", "multimodal"]="text"):
+        return self.chains[mode]
     
     def update_retriever(self, retriver_doc_num:int = 10, score_threshold:float = 0.6):
         self.set_retriever(retriver_doc_num=retriver_doc_num, score_threshold=score_threshold)
         self.set_chain()
-    
-    def update_prompt_template(self, mode:Literal["text", "multimodal"]="text"):
-        self.set_prompt_template(mode=mode)
-        self.set_chain()
+
+    def resolve_blueprint(self, base64_image:str):
+        """Match an uploaded image against the local blueprint index and name its blueprint."""
+        if self.image_index is None:
+            return None
+        try:
+            matched = self.image_index.match(Image.open(BytesIO(base64.b64decode(base64_image))))
+        except Exception:
+            return None
+        if matched is None:
+            return None
+
+        docs = self.retriever_manager.get(where={"blueprint": matched[0]}, limit=1, include=[])
+        if len(docs["ids"]) == 0:
+            return None
+        # Only the name: the hint reaches the range planner, which would read a
+        # classification path such as "너트>나비너트>1종" as the bound "> 1".
+        return f"Uploaded blueprint: {matched[0]}"
+
+    def _make_inputs(self, text:str, base64_image:str=None):
+        if base64_image is None:
+            return "text", {"input": text}
+
+        # A known blueprint is resolved locally, so the LLM calls stay text-only.
+        blueprint = self.resolve_blueprint(base64_image)
+        if blueprint is not None:
+            return "text", {"input": text, "blueprint": blueprint}
+        else:
+            # A smaller image is sent to both the rewrite and the answer call.
+            return "multimodal", {"input": text, "base64_image": shrink_b64_image(base64_image)}
     
     def update_context(self, session_id:str, context:List[Document]):
         ids = []
@@ -127,26 +264,57 @@ class ChatManager:
                 id = doc.metadata.get("id", None)
                 if id is not None:
                     ids.append(id)
-        self.context_store[session_id] = ids
+        get_session_store().update(session_id, context=ids)
     
     def get_context(self, session_id:str):
-        return self.context_store.get(session_id, None)
+        return get_session_store().get(session_id).get("context", None)
+
+    async def aget_context(self, session_id:str):
+        # The session store may be sqlite; keep it off the event loop.
+        return await run_in_executor(None, self.get_context, session_id)
 
     def get_docs_from_ids(self, ids:List[str]):
         return self.retriever_manager.get(ids, include=["documents", "metadatas"])
 
+    def _collect_chunk(self, output:dict, chunk:dict):
+        for key in ("standalone", "answer"):
+            if key in chunk:
+                output[key] += chunk[key]
+        for key in ("context", "cached_answer"):
+            if key in chunk:
+                output[key] = chunk[key]
+
+    def _make_stream_config(self, session_id:str, restarts:list):
+        return {
+            "configurable": {
+                "session_id": session_id,
+                "on_stream_restart": lambda: restarts.append(session_id),
+            },
+        }
+
+    def _collect_stream_chunk(self, output:dict, chunk:dict, restarts:list, handled:int):
+        """Collect a chunk; after a stream restart the partial answer is dropped first."""
+        notice = None
+        if "answer" in chunk and len(restarts) > handled:
+            output["answer"] = ""
+            notice = ResilientStream.RESTART_NOTICE
+        self._collect_chunk(output, chunk)
+        return notice, len(restarts) if notice is not None else handled
+
+    def _finish_stream(self, session_id:str, output:dict, restarts:list):
+        if len(restarts) > 0:
+            # History recorded every attempt concatenated; keep only the final answer.
+            get_session_history(session_id).replace_last_answer(output["answer"])
+        if len(output["context"]) > 0:
+            self.update_context(session_id, output["context"])
+
     def query(self, text:str, base64_image:str=None, session_id:str="abc123"):
-        if base64_image == None:
-            self.update_prompt_template(mode="text")
-            inputs = {"input": text}
-        else:
-            self.update_prompt_template(mode="multimodal")
-            inputs = {"input": text, "base64_image": base64_image}
+        mode, inputs = self._make_inputs(text, base64_image)
         
         config = {
             "configurable": {"session_id": session_id},
         }
-        output = self.chain.invoke(
+        output = self.get_chain(mode).invoke(
             inputs,
             config=config
         )
@@ -154,6 +322,7 @@ class ChatManager:
 
         if len(context) > 0:
             self.update_context(session_id, output["context"])
+        self.remember_answer(inputs, output)
         
         return output["answer"]
 
@@ -163,22 +332,68 @@ class ChatManager:
             base64_image: str = None,
             session_id: str = "abc123"
         )-> Generator[Document, None, None]:
-        if base64_image is None:
-            self.update_prompt_template(mode="text")
-            inputs = {"input": text}
-        else:
-            self.update_prompt_template(mode="multimodal")
-            inputs = {"input": text, "base64_image": base64_image}
+        mode, inputs = self._make_inputs(text, base64_image)
+        
+        restarts, handled = [], 0
+        config = self._make_stream_config(session_id, restarts)
+        
+        output = {"standalone": "", "context": [], "cached_answer": None, "answer": ""}
+        stream = self.get_chain(mode).stream(inputs, config=config)
+        try:
+            for chunk in stream:
+                notice, handled = self._collect_stream_chunk(output, chunk, restarts, handled)
+                if notice is not None:
+                    yield notice
+                if "answer" in chunk:
+                    yield chunk["answer"]
+        finally:
+            # Abandoned streams (e.g. a Streamlit rerun) release the LLM connection right away.
+            stream.close()
+        
+        self._finish_stream(session_id, output, restarts)
+        self.remember_answer(inputs, output)
+
+    async def aquery(self, text:str, base64_image:str=None, session_id:str="abc123"):
+        # Image decoding, blueprint matching and the Chroma lookup would block every other stream.
+        mode, inputs = await run_in_executor(None, self._make_inputs, text, base64_image)
         
         config = {
             "configurable": {"session_id": session_id},
         }
+        output = await self.get_chain(mode).ainvoke(
+            inputs,
+            config=config
+        )
+        context = output["context"]
+
+        if len(context) > 0:
+            await run_in_executor(None, self.update_context, session_id, context)
+        await run_in_executor(None, self.remember_answer, inputs, output)
+        
+        return output["answer"]
+
+    async def aquery_stream(
+            self,
+            text: str,
+            base64_image: str = None,
+            session_id: str = "abc123"
+        )-> AsyncGenerator[str, None]:
+        mode, inputs = await run_in_executor(None, self._make_inputs, text, base64_image)
         
-        for chunk in self.chain.stream(inputs, config=config):
-            if "answer" in chunk:
-                yield chunk["answer"]
-            if "context" in chunk:
-                context = chunk["context"]
+        restarts, handled = [], 0
+        config = self._make_stream_config(session_id, restarts)
         
-        if len(context) > 0:
-            self.update_context(session_id, context)
+        output = {"standalone": "", "context": [], "cached_answer": None, "answer": ""}
+        stream = self.get_chain(mode).astream(inputs, config=config)
+        try:
+            async for chunk in stream:
+                notice, handled = self._collect_stream_chunk(output, chunk, restarts, handled)
+                if notice is not None:
+                    yield notice
+                if "answer" in chunk:
+                    yield chunk["answer"]
+        finally:
+            await stream.aclose()
+        
+        await run_in_executor(None, self._finish_stream, session_id, output, restarts)
+        await run_in_executor(None, self.remember_answer, inputs, output)
@@ -0,0 +1,125 @@
+import os
+import time
+import sqlite3
+import hashlib
+import threading
+from array import array
+from collections import OrderedDict
+from typing import List
+
+from langchain_core.embeddings import Embeddings
+
+class CachedEmbeddings(Embeddings):
+    """Disk-backed embedding cache in front of a remote embedding model.
+
+    Vectors are stored as float32 blobs in sqlite, keyed by model name plus the
+    SHA-256 of the text. Document embeddings are kept forever, query embeddings
+    are evicted least-recently-used once `max_query_entries` is exceeded.
+    """
+
+    def __init__(
+        self,
+        embeddings:Embeddings,
+        model_name:str,
+        cache_path:str,
+        max_query_entries:int = 10000,
+        memory_query_entries:int = 1000,
+    ):
+        self.embeddings = embeddings
+        self.model_name = model_name
+        self.max_query_entries = max_query_entries
+        self.memory_query_entries = memory_query_entries
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+
+        cache_dir = os.path.dirname(cache_path)
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+        self._conn = sqlite3.connect(cache_path, check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings ("
+            "key TEXT PRIMARY KEY, kind TEXT NOT NULL, vector BLOB NOT NULL, last_used REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_kind_used ON embeddings (kind, last_used)")
+        self._conn.commit()
+
+    def _make_key(self, text:str):
+        return self.model_name + ":" + hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+    def _to_blob(self, vector:List[float]):
+        return array("f", vector).tobytes()
+
+    def _from_blob(self, blob:bytes):
+        vector = array("f")
+        vector.frombytes(blob)
+        return vector.tolist()
+
+    def _load(self, keys:List[str]):
+        found = {}
+        for start in range(0, len(keys), 500):
+            chunk = keys[start:start + 500]
+            rows = self._conn.execute(
+                f"SELECT key, vector FROM embeddings WHERE key IN ({','.join('?' * len(chunk))})",
+                chunk
+            ).fetchall()
+            found.update((key, self._from_blob(blob)) for key, blob in rows)
+        return found
+
+    def _save(self, items:List[tuple], kind:str):
+        now = time.time()
+        self._conn.executemany(
+            "INSERT OR REPLACE INTO embeddings (key, kind, vector, last_used) VALUES (?, ?, ?, ?)",
+            [(key, kind, self._to_blob(vector), now) for key, vector in items]
+        )
+        self._conn.commit()
+
+    def _evict_queries(self):
+        self._conn.execute(
+            "DELETE FROM embeddings WHERE kind = 'query' AND key NOT IN ("
+            "SELECT key FROM embeddings WHERE kind = 'query' ORDER BY last_used DESC LIMIT ?)",
+            (self.max_query_entries,)
+        )
+        self._conn.commit()
+
+    def embed_documents(self, texts:List[str]) -> List[List[float]]:
+        keys = [self._make_key(text) for text in texts]
+        with self._lock:
+            found = self._load(list(set(keys)))
+
+        missing = {}
+        for key, text in zip(keys, texts):
+            if key not in found:
+                missing[key] = text
+
+        if missing:
+            vectors = self.embeddings.embed_documents(list(missing.values()))
+            new_items = list(zip(missing.keys(), vectors))
+            with self._lock:
+                self._save(new_items, kind="document")
+            found.update(new_items)
+
+        return [found[key] for key in keys]
+
+    def embed_query(self, text:str) -> List[float]:
+        key = self._make_key(text)
+        with self._lock:
+            if key in self._memory:
+                self._memory.move_to_end(key)
+                return self._memory[key]
+
+            vector = self._load([key]).get(key)
+            if vector is not None:
+                self._conn.execute("UPDATE embeddings SET last_used = ? WHERE key = ?", (time.time(), key))
+                self._conn.commit()
+
+        if vector is None:
+            vector = self.embeddings.embed_query(text)
+            with self._lock:
+                self._save([(key, vector)], kind="query")
+                self._evict_queries()
+
+        with self._lock:
+            self._memory[key] = vector
+            if len(self._memory) > self.memory_query_entries:
+                self._memory.popitem(last=False)
+        return vector
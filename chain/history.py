@@ -1,24 +1,273 @@
+import os
+import json
+import time
+import sqlite3
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional
 from langchain_community.chat_message_histories import ChatMessageHistory
+from langchain_core.messages import (
+    AIMessage,
+    BaseMessage,
+    HumanMessage,
+    messages_from_dict,
+    messages_to_dict,
+)
 from langchain_core.runnables.history import RunnableWithMessageHistory
 
+from utils import estimate_tokens
+
+class InMemorySessionBackend:
+    def __init__(self):
+        self._sessions = OrderedDict()  # session_id -> (data, last_access, size)
+
+    def get(self, session_id:str):
+        if session_id not in self._sessions:
+            return None
+        self._sessions.move_to_end(session_id)
+        return self._sessions[session_id]
+
+    def set(self, session_id:str, data:dict, last_access:float, size:int):
+        self._sessions[session_id] = (data, last_access, size)
+        self._sessions.move_to_end(session_id)
+
+    def touch(self, session_id:str, last_access:float):
+        data, _, size = self._sessions[session_id]
+        self._sessions[session_id] = (data, last_access, size)
+        self._sessions.move_to_end(session_id)
+
+    def delete(self, session_id:str):
+        self._sessions.pop(session_id, None)
+
+    def stats(self):
+        return len(self._sessions), sum(size for _, _, size in self._sessions.values())
+
+    def expired(self, before:float) -> List[str]:
+        return [id for id, (_, last_access, _) in self._sessions.items() if last_access < before]
+
+    def least_recent(self) -> Optional[str]:
+        return next(iter(self._sessions), None)
+
+class SqliteSessionBackend:
+    def __init__(self, path:str):
+        path_dir = os.path.dirname(path)
+        if path_dir:
+            os.makedirs(path_dir, exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS sessions ("
+            "session_id TEXT PRIMARY KEY, data TEXT NOT NULL, last_access REAL NOT NULL, size INTEGER NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_last_access ON sessions (last_access)")
+        self._conn.commit()
+
+    def get(self, session_id:str):
+        row = self._conn.execute(
+            "SELECT data, last_access, size FROM sessions WHERE session_id = ?", (session_id,)
+        ).fetchone()
+        if row is None:
+            return None
+        return json.loads(row[0]), row[1], row[2]
+
+    def set(self, session_id:str, data:dict, last_access:float, size:int):
+        self._conn.execute(
+            "INSERT OR REPLACE INTO sessions (session_id, data, last_access, size) VALUES (?, ?, ?, ?)",
+            (session_id, json.dumps(data, ensure_ascii=False), last_access, size)
+        )
+        self._conn.commit()
+
+    def touch(self, session_id:str, last_access:float):
+        self._conn.execute("UPDATE sessions SET last_access = ? WHERE session_id = ?", (last_access, session_id))
+        self._conn.commit()
+
+    def delete(self, session_id:str):
+        self._conn.execute("DELETE FROM sessions WHERE session_id = ?", (session_id,))
+        self._conn.commit()
+
+    def stats(self):
+        count, size = self._conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM sessions").fetchone()
+        return count, size
+
+    def expired(self, before:float) -> List[str]:
+        rows = self._conn.execute("SELECT session_id FROM sessions WHERE last_access < ?", (before,)).fetchall()
+        return [row[0] for row in rows]
+
+    def least_recent(self) -> Optional[str]:
+        row = self._conn.execute("SELECT session_id FROM sessions ORDER BY last_access LIMIT 1").fetchone()
+        return row[0] if row is not None else None
+
+class SessionStore:
+    """Per-session state (chat history, context ids) with LRU, idle-TTL and memory-budget eviction.
+
+    Only the least recently used or idle sessions are evicted, one at a time,
+    so active users keep their conversation.
+    """
+
+    def __init__(
+        self,
+        backend = None,
+        max_sessions:int = 1000,
+        ttl_seconds:float = 3600,
+        max_bytes:int = 64 * 1024 * 1024,
+    ):
+        self.backend = backend if backend is not None else InMemorySessionBackend()
+        self.max_sessions = max_sessions
+        self.ttl_seconds = ttl_seconds
+        self.max_bytes = max_bytes
+        self._lock = threading.RLock()
+
+    def _evict(self):
+        now = time.time()
+        if self.ttl_seconds is not None:
+            for session_id in self.backend.expired(now - self.ttl_seconds):
+                self.backend.delete(session_id)
+
+        count, size = self.backend.stats()
+        while count > 0 and (
+            count > self.max_sessions or (self.max_bytes is not None and size > self.max_bytes)
+        ):
+            self.backend.delete(self.backend.least_recent())
+            count, size = self.backend.stats()
+
+    def get(self, session_id:str) -> Dict[str, Any]:
+        with self._lock:
+            entry = self.backend.get(session_id)
+            if entry is None:
+                return {}
+            data, last_access, _ = entry
+            if self.ttl_seconds is not None and last_access < time.time() - self.ttl_seconds:
+                self.backend.delete(session_id)
+                return {}
+            self.backend.touch(session_id, time.time())
+            return dict(data)
+
+    def update(self, session_id:str, **values):
+        with self._lock:
+            data = self.get(session_id)
+            data.update(values)
+            size = len(json.dumps(data, ensure_ascii=False).encode("utf-8"))
+            self.backend.set(session_id, data, time.time(), size)
+            self._evict()
+
 class TruncatedChatMessageHistory(ChatMessageHistory):
+    """Chat history capped by message count and an estimated token budget.
+
+    Turns that no longer fit are folded into one short summary turn at the
+    front, oversized messages are clipped and base64 image payloads are never stored.
+    """
     max_length = 5
+    max_tokens = 1500
+    max_message_tokens = 600
+    max_summary_chars = 600
+    summary_name = "history_summary"
+    session_id: str = ""
+    store: Any = None
+
+    def __init__(self, session_id:str = "", store:SessionStore = None):
+        super().__init__(session_id=session_id, store=store)
+        if store is not None:
+            self.messages = messages_from_dict(store.get(session_id).get("messages", []))
+
+    def _to_text(self, content) -> str:
+        if isinstance(content, str):
+            return content
+        texts = []
+        for part in content:
+            if isinstance(part, str):
+                texts.append(part)
+            elif part.get("type") == "text":
+                texts.append(part.get("text", ""))
+            else:
+                texts.append("[image]")
+        return " ".join(texts)
+
+    def _sanitize(self, message:BaseMessage) -> BaseMessage:
+        text = self._to_text(message.content)
+        max_chars = self.max_message_tokens * 4
+        if len(text) > max_chars:
+            text = text[:max_chars] + " ...(truncated)"
+        if text == message.content:
+            return message
+        return message.copy(update={"content": text})
+
+    def _has_summary(self) -> bool:
+        return (
+            len(self.messages) >= 2
+            and self.messages[0].name == self.summary_name
+            and self.messages[1].name == self.summary_name
+        )
+
+    def _compact(self):
+        # The summary is kept as a human/ai pair so providers that need alternating roles accept it.
+        summary = self.messages[1].content if self._has_summary() else None
+        turns = self.messages[2:] if summary is not None else list(self.messages)
+
+        def _over_budget():
+            tokens = sum(estimate_tokens(cur.content) for cur in turns)
+            if summary is not None:
+                tokens += estimate_tokens(summary)
+            return len(turns) > self.max_length or tokens > self.max_tokens
+
+        while len(turns) > 1 and _over_budget():
+            folded = [turns.pop(0)]
+            if folded[0].type == "human" and len(turns) > 1 and turns[0].type == "ai":
+                folded.append(turns.pop(0))
+            for oldest in folded:
+                line = f"{oldest.type}: {oldest.content[:200]}"
+                summary = line if summary is None else summary + "\n" + line
+            summary = summary[-self.max_summary_chars:]
+
+        if summary is not None:
+            turns = [
+                HumanMessage(content="Summarize our earlier conversation.", name=self.summary_name),
+                AIMessage(content=summary, name=self.summary_name),
+            ] + turns
+        self.messages = turns
 
-    def __init__(self):
-        super().__init__()
-        
     def add_messages(self, new_msg):
-        if len(self.messages) >= self.max_length:
-            self.messages.pop(0)
-        super().add_messages(new_msg)
-        
-HISTORY_STORE = {}
-def get_session_history(session_id:str, limit_release_history_length:int=1000):
-    global HISTORY_STORE
-    if session_id not in HISTORY_STORE:
-        HISTORY_STORE[session_id] = TruncatedChatMessageHistory()
-    
-    if len(HISTORY_STORE) >= limit_release_history_length:
-        HISTORY_STORE = {session_id:HISTORY_STORE[session_id]}
-
-    return HISTORY_STORE[session_id]
+        super().add_messages([self._sanitize(cur) for cur in new_msg])
+        self._compact()
+        if self.store is not None:
+            self.store.update(self.session_id, messages=messages_to_dict(self.messages))
+
+    def replace_last_answer(self, content:str):
+        """Overwrite the latest AI message, e.g. with the final attempt of a restarted stream."""
+        for idx in range(len(self.messages) - 1, -1, -1):
+            if self.messages[idx].type == "ai":
+                self.messages[idx] = self._sanitize(self.messages[idx].copy(update={"content": content}))
+                break
+        else:
+            return
+        if self.store is not None:
+            self.store.update(self.session_id, messages=messages_to_dict(self.messages))
+
+    def clear(self):
+        super().clear()
+        if self.store is not None:
+            self.store.update(self.session_id, messages=[])
+
+def make_session_store() -> SessionStore:
+    if os.environ.get("SESSION_BACKEND", "memory") == "sqlite":
+        backend = SqliteSessionBackend(os.environ.get("SESSION_DB_PATH", "./sessions/sessions.sqlite"))
+    else:
+        backend = InMemorySessionBackend()
+    return SessionStore(
+        backend=backend,
+        max_sessions=int(os.environ.get("SESSION_MAX_COUNT", 1000)),
+        ttl_seconds=float(os.environ.get("SESSION_TTL_SECONDS", 3600)),
+        max_bytes=int(os.environ.get("SESSION_MAX_BYTES", 64 * 1024 * 1024)),
+    )
+
+# Built on first use so SESSION_* from a .env loaded after import is honored.
+_SESSION_STORE = None
+_SESSION_STORE_LOCK = threading.Lock()
+
+def get_session_store() -> SessionStore:
+    global _SESSION_STORE
+    with _SESSION_STORE_LOCK:
+        if _SESSION_STORE is None:
+            _SESSION_STORE = make_session_store()
+        return _SESSION_STORE
+
+def get_session_history(session_id:str):
+    return TruncatedChatMessageHistory(session_id=session_id, store=get_session_store())
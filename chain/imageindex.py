@@ -0,0 +1,106 @@
+import os
+from glob import glob
+from typing import List, Optional, Tuple
+
+import numpy as np
+from PIL import Image
+
+class BlueprintImageIndex:
+    """Local index of blueprint images for matching uploads without an LLM call.
+
+    Every blueprint gets a difference hash (perceptual, robust to rescaling and
+    re-encoding) and a small grayscale thumbnail embedding. An upload matches
+    when exactly one blueprint is within `max_hamming` bits and its embedding
+    cosine similarity is at least `min_similarity`.
+    """
+
+    def __init__(
+        self,
+        hash_size:int = 8,
+        embed_size:int = 32,
+        max_hamming:int = 6,
+        min_similarity:float = 0.9,
+    ):
+        self.hash_size = hash_size
+        self.embed_size = embed_size
+        self.max_hamming = max_hamming
+        self.min_similarity = min_similarity
+        self.names = []
+        self.hashes = np.zeros((0, hash_size * hash_size // 8), dtype=np.uint8)
+        self.embeddings = np.zeros((0, embed_size * embed_size), dtype=np.float32)
+
+    def __len__(self):
+        return len(self.names)
+
+    def _features(self, img) -> Tuple[np.ndarray, np.ndarray]:
+        gray = img.convert("L")
+
+        small = np.asarray(gray.resize((self.hash_size + 1, self.hash_size), Image.LANCZOS), dtype=np.int16)
+        bits = np.packbits((small[:, 1:] > small[:, :-1]).ravel())
+
+        thumb = np.asarray(gray.resize((self.embed_size, self.embed_size), Image.LANCZOS), dtype=np.float32).ravel()
+        thumb -= thumb.mean()
+        norm = np.linalg.norm(thumb)
+        return bits, (thumb / norm if norm > 0 else thumb)
+
+    def build(self, paths:List[str]):
+        names, hashes, embeddings = [], [], []
+        for path in paths:
+            try:
+                with Image.open(path) as img:
+                    bits, embedding = self._features(img)
+            except OSError as e:
+                print(f"Skip {os.path.basename(path)} cause '{e}'---")
+                continue
+            names.append(os.path.basename(path))
+            hashes.append(bits)
+            embeddings.append(embedding)
+
+        self.names = names
+        if names:
+            self.hashes = np.stack(hashes)
+            self.embeddings = np.stack(embeddings)
+        return self
+
+    def match(self, img) -> Optional[Tuple[str, float]]:
+        if len(self.names) == 0:
+            return None
+        bits, embedding = self._features(img)
+        distances = np.unpackbits(np.bitwise_xor(self.hashes, bits[None]), axis=1).sum(axis=1)
+        candidates = np.flatnonzero(distances <= self.max_hamming)
+        # Near-identical blueprints are ambiguous; let the LLM look at the image instead.
+        if len(candidates) != 1:
+            return None
+        best = int(candidates[0])
+        similarity = float(self.embeddings[best] @ embedding)
+        if similarity < self.min_similarity:
+            return None
+        return self.names[best], similarity
+
+    def save(self, path:str):
+        path_dir = os.path.dirname(path)
+        if path_dir:
+            os.makedirs(path_dir, exist_ok=True)
+        with open(path, "wb") as f:
+            np.savez(
+                f,
+                names=np.array(self.names, dtype=str),
+                hashes=self.hashes,
+                embeddings=self.embeddings,
+                sizes=np.array([self.hash_size, self.embed_size]),
+            )
+
+    @classmethod
+    def load(cls, path:str, **kwargs) -> "BlueprintImageIndex":
+        with np.load(path) as data:
+            hash_size, embed_size = (int(cur) for cur in data["sizes"])
+            index = cls(hash_size=hash_size, embed_size=embed_size, **kwargs)
+            index.names = data["names"].tolist()
+            index.hashes = data["hashes"]
+            index.embeddings = data["embeddings"]
+        return index
+
+def build_blueprint_index(bp_dir:str, index_path:str) -> BlueprintImageIndex:
+    index = BlueprintImageIndex().build(sorted(glob(os.path.join(bp_dir, "*"))))
+    index.save(index_path)
+    return index
@@ -0,0 +1,285 @@
+import re
+import math
+import heapq
+from bisect import bisect_left, bisect_right
+from typing import List, Tuple, Optional, Iterable
+
+from utils import json_loads
+
+class NumericRangeIndex:
+    """Columnar index of dimension values.
+
+    One sorted column per (classification, dimension) where dimension is the
+    template alphabet (e.g. "D") or the lowercased dimension name (e.g. "height").
+    Columns are re-sorted lazily after inserts, so range lookups are O(log n).
+    """
+
+    def __init__(self):
+        self._values = {}   # (family, dimension) -> {doc_id: value}
+        self._columns = {}  # (family, dimension) -> (sorted values, ids)
+        self._names = set()
+        self._alphabets = set()
+        self._families = set()
+
+    def __len__(self):
+        return len(set(id for values in self._values.values() for id in values))
+
+    @property
+    def names(self):
+        return self._names
+
+    @property
+    def alphabets(self):
+        return self._alphabets
+
+    @property
+    def families(self):
+        return self._families
+
+    def add(self, doc_id:str, content:dict):
+        family = content.get("classification")
+        for dim_detail in content.get("dimension_details", []):
+            try:
+                value = float(dim_detail["value"])
+            except (KeyError, TypeError, ValueError):
+                continue
+
+            dimensions = []
+            if dim_detail.get("alphabet"):
+                dimensions.append(str(dim_detail["alphabet"]))
+                self._alphabets.add(dimensions[-1])
+            if dim_detail.get("name"):
+                dimensions.append(str(dim_detail["name"]).lower())
+                self._names.add(dimensions[-1])
+
+            for dimension in dimensions:
+                key = (family, dimension)
+                self._values.setdefault(key, {})[doc_id] = value
+                self._columns.pop(key, None)
+        self._families.add(family)
+
+    def add_documents(self, ids:Iterable[str], page_contents:Iterable[str]):
+        for doc_id, page_content in zip(ids, page_contents):
+            try:
+                content = json_loads(page_content)
+            except (TypeError, ValueError):
+                continue
+            self.add(doc_id, content)
+
+    def _get_column(self, key:Tuple[str, str]):
+        if key not in self._columns:
+            pairs = sorted((value, id) for id, value in self._values[key].items())
+            self._columns[key] = ([value for value, _ in pairs], [id for _, id in pairs])
+        return self._columns[key]
+
+    def range(
+        self,
+        dimension:str,
+        low:float = None,
+        high:float = None,
+        include_low:bool = True,
+        include_high:bool = True,
+        families:List[str] = None,
+    ) -> set:
+        ids = set()
+        for key in self._values:
+            family, cur_dimension = key
+            if cur_dimension != dimension:
+                continue
+            if families is not None and family not in families:
+                continue
+
+            values, col_ids = self._get_column(key)
+            if low is None:
+                start = 0
+            elif include_low:
+                start = bisect_left(values, low)
+            else:
+                start = bisect_right(values, low)
+            if high is None:
+                end = len(values)
+            elif include_high:
+                end = bisect_right(values, high)
+            else:
+                end = bisect_left(values, high)
+            ids.update(col_ids[start:end])
+        return ids
+
+    def search(self, predicates:List[dict], families:List[str] = None) -> set:
+        result = None
+        for predicate in predicates:
+            ids = self.range(families=families, **predicate)
+            result = ids if result is None else result & ids
+            if not result:
+                break
+        return result or set()
+
+
+class RangeQueryPlanner:
+    """Extracts numeric range predicates from a standalone question.
+
+    "bolt with a height greater than 10.0mm and smaller than 12.1mm"
+    -> [{"dimension": "height", "low": 10.0, "high": 12.1, ...}]
+    """
+
+    NUMBER = r"(-?\d+(?:\.\d+)?)\s*(?:mm)?"
+    LOWER_BOUND = r"(?:greater|larger|bigger|more|longer|higher|wider|thicker|over|above)(?:\s+than)?"
+    UPPER_BOUND = r"(?:smaller|less|lower|shorter|narrower|thinner|under|below)(?:\s+than)?"
+    OR_EQUAL = r"(?:\s+or\s+equal(?:\s+to)?)?"
+
+    def __init__(self, index:NumericRangeIndex):
+        self.index = index
+
+    def _make_dimension_pattern(self):
+        names = sorted(self.index.names, key=len, reverse=True)
+        alphabets = sorted(self.index.alphabets, key=len, reverse=True)
+
+        patterns = []
+        if names:
+            patterns.append(r"(?i:\b(?P<name>" + "|".join(map(re.escape, names)) + r")\b)")
+        if alphabets:
+            # Single letters are only trusted when quoted, e.g. 'D' or (D).
+            alphabet_group = "|".join(map(re.escape, alphabets))
+            patterns.append(r"['\"(](?P<quoted>" + alphabet_group + r")['\")]")
+            multi_letter = [cur for cur in alphabets if len(cur) > 1]
+            if multi_letter:
+                patterns.append(r"\b(?P<alphabet>" + "|".join(map(re.escape, multi_letter)) + r")\b")
+        if not patterns:
+            return None
+        return re.compile("|".join(patterns))
+
+    def _make_bound_pattern(self):
+        return re.compile(
+            rf"(?P<between>between\s+{self.NUMBER}\s+and\s+{self.NUMBER})"
+            rf"|(?P<lower>{self.LOWER_BOUND}{self.OR_EQUAL}\s+{self.NUMBER})"
+            rf"|(?P<upper>{self.UPPER_BOUND}{self.OR_EQUAL}\s+{self.NUMBER})"
+            rf"|(?P<symbol>>=|<=|>|<)\s*{self.NUMBER}",
+            re.IGNORECASE
+        )
+
+    def _match_families(self, question:str) -> Optional[List[str]]:
+        lowered = question.lower()
+        families = []
+        for family in self.index.families:
+            if family is None:
+                continue
+            segments = [cur.strip().lower() for cur in str(family).split(">")]
+            if any(len(cur) > 1 and cur in lowered for cur in segments):
+                families.append(family)
+        return families or None
+
+    def plan(self, question:str) -> Tuple[List[dict], Optional[List[str]]]:
+        dimension_pattern = self._make_dimension_pattern()
+        if dimension_pattern is None:
+            return [], None
+
+        dimension_spans, dimension_ends = [], set()
+        for match in dimension_pattern.finditer(question):
+            groups = match.groupdict()
+            if groups.get("name"):
+                dimension = groups["name"].lower()
+            else:
+                dimension = groups.get("quoted") or groups.get("alphabet")
+            dimension_spans.append((match.start(), dimension))
+            dimension_ends.add(match.end())
+
+        bounds = {}
+        for match in self._make_bound_pattern().finditer(question):
+            # A bare symbol must stand apart or follow the dimension ("D>3", "D > 3"),
+            # so a path such as "너트>나비너트>1종" is not read as a bound.
+            if match.group("symbol") and not (
+                match.start() == 0 or question[match.start() - 1].isspace() or match.start() in dimension_ends
+            ):
+                continue
+            preceding = [dim for start, dim in dimension_spans if start < match.start()]
+            if not preceding:
+                continue
+            dimension = preceding[-1]
+            bound = bounds.setdefault(dimension, {
+                "dimension": dimension, "low": None, "high": None,
+                "include_low": True, "include_high": True,
+            })
+            text = match.group(0).lower()
+            numbers = [float(cur) for cur in re.findall(r"-?\d+(?:\.\d+)?", text)]
+            inclusive = "equal" in text or "=" in text
+
+            if match.group("between"):
+                bound["low"], bound["high"] = min(numbers), max(numbers)
+                bound["include_low"] = bound["include_high"] = True
+            elif match.group("lower") or match.group("symbol") in (">", ">="):
+                bound["low"], bound["include_low"] = numbers[-1], inclusive
+            else:
+                bound["high"], bound["include_high"] = numbers[-1], inclusive
+
+        return list(bounds.values()), self._match_families(question)
+
+
+class BM25Index:
+    """In-process inverted index with Okapi BM25 scoring.
+
+    Tokens keep exact codes intact ("m10x16", "dk", "g1") and Hangul runs are
+    also split into bigrams so "나비너트" matches "나비 너트".
+    """
+
+    TOKEN_PATTERN = re.compile(r"[0-9a-zA-Z]+(?:[.'][0-9a-zA-Z]+)*'?|[가-힣]+")
+
+    def __init__(self, k1:float = 1.2, b:float = 0.75):
+        self.k1 = k1
+        self.b = b
+        self._postings = {}  # token -> {doc_id: term frequency}
+        self._doc_tokens = {}  # doc_id -> list of tokens
+        self._total_length = 0
+
+    def __len__(self):
+        return len(self._doc_tokens)
+
+    def tokenize(self, text:str) -> List[str]:
+        tokens = []
+        for token in self.TOKEN_PATTERN.findall(text.lower()):
+            tokens.append(token)
+            if "가" <= token[0] <= "힣" and len(token) > 2:
+                tokens.extend(token[i:i + 2] for i in range(len(token) - 1))
+        return tokens
+
+    def remove(self, doc_id:str):
+        tokens = self._doc_tokens.pop(doc_id, None)
+        if tokens is None:
+            return
+        self._total_length -= len(tokens)
+        for token in set(tokens):
+            postings = self._postings[token]
+            postings.pop(doc_id, None)
+            if not postings:
+                del self._postings[token]
+
+    def add(self, doc_id:str, text:str):
+        self.remove(doc_id)
+        tokens = self.tokenize(text)
+        self._doc_tokens[doc_id] = tokens
+        self._total_length += len(tokens)
+        for token in tokens:
+            postings = self._postings.setdefault(token, {})
+            postings[doc_id] = postings.get(doc_id, 0) + 1
+
+    def add_documents(self, ids:Iterable[str], texts:Iterable[str]):
+        for doc_id, text in zip(ids, texts):
+            self.add(doc_id, text)
+
+    def search(self, query:str, k:int = 10, allowed_ids:set = None) -> List[Tuple[str, float]]:
+        if len(self._doc_tokens) == 0:
+            return []
+        n_docs = len(self._doc_tokens)
+        avg_length = self._total_length / n_docs
+        scores = {}
+        for token in set(self.tokenize(query)):
+            postings = self._postings.get(token)
+            if not postings:
+                continue
+            idf = math.log(1 + (n_docs - len(postings) + 0.5) / (len(postings) + 0.5))
+            for doc_id, tf in postings.items():
+                if allowed_ids is not None and doc_id not in allowed_ids:
+                    continue
+                length = len(self._doc_tokens[doc_id])
+                norm = tf + self.k1 * (1 - self.b + self.b * length / avg_length)
+                scores[doc_id] = scores.get(doc_id, 0.0) + idf * tf * (self.k1 + 1) / norm
+        return heapq.nlargest(k, scores.items(), key=lambda item: item[1])
@@ -1,5 +1,6 @@
-import os, re, time
+import os, re
 import json
+import hashlib
 from typing import Literal, List
 from langchain_core.pydantic_v1 import (
     BaseModel,
@@ -11,7 +12,9 @@ from langchain.prompts import (
     ChatPromptTemplate,
 )
 from langchain_core.messages import AIMessage
+from chain.cache import TemplateCache
 from chain.llm import SimpleLLM
+from chain.ratelimit import TokenBucketRateLimiter
 from chain.prompt import (
     PREFIX_KNOWLEDGE_BASE_PROMPT,
     SUFFIX_KNOWLEDGE_BASE_PROMPT,
@@ -44,10 +47,14 @@ class KnowledgeBaseTemplateChain(SimpleLLM):
         llm_type: Literal['google', 'openai', 'anthropic'],
         model_name: str = None,
         retry_count: int = 3,
+        rate_limiter: TokenBucketRateLimiter = None,
+        template_cache: TemplateCache = None,
     ):
         super().__init__(llm_type, model_name, retry_count)
         
         self.retry_count = retry_count
+        self.rate_limiter = rate_limiter
+        self.template_cache = template_cache
         self.system_message = self._make_sysmsg_with_fewshot(examples=EXAMPLE_KNOWLEDGE_BASE_LIST)
         self.chain = \
             self.KNOWLEDGEBASE_PROMPT_TEMPLATE \
@@ -82,20 +89,50 @@ class KnowledgeBaseTemplateChain(SimpleLLM):
     def update_sysmsg_with_fewshot(self, examples:List[dict] = []):
         self.system_message = self._make_sysmsg_with_fewshot(examples=examples)
 
-    def invoke(self, image_path:str, features:dict):
+    def _hash_image(self, image_path:str) -> str:
+        with open(image_path, "rb") as f:
+            return hashlib.sha256(f.read()).hexdigest()
+
+    def invalidate_cache(self, image_path:str = None):
+        if self.template_cache is not None:
+            self.template_cache.invalidate(None if image_path is None else self._hash_image(image_path))
+
+    def _make_template(self, image_path:str, features:dict, dimension_details:List[dict]):
+        return {
+            "part_type": features["part_type"],
+            "classification": features["classification"],
+            "dimension_details": dimension_details,
+            "metadata": {
+                "blueprint":os.path.basename(image_path), 
+                "ori_features":json.dumps(features, ensure_ascii=False)
+            }
+        }
+
+    def invoke(self, image_path:str, features:dict, force_regenerate:bool = False):
+        cache_key = None
+        if self.template_cache is not None:
+            image_hash = self._hash_image(image_path)
+            cache_key = self.template_cache.make_key(image_hash, features)
+            cached = None if force_regenerate else self.template_cache.get(cache_key)
+            if cached is not None:
+                # Names and descriptions are reused, values come from the current row.
+                for cur in cached:
+                    if cur.get("alphabet") in features:
+                        cur["value"] = features[cur["alphabet"]]
+                return self._make_template(image_path, features, cached)
+
         base64_image = open_img(image_path, mode="b64")
         
-        for retry_idx in range(self.retry_count):
-            try:
-                output_list = self.chain.invoke({
-                    "system_message":self.system_message,
-                    "base64_image":base64_image,
-                    "features":features,
-                })
-                break
-            except Exception as e:
-                print(f"Retry({retry_idx})... cause '{e}'")
-                time.sleep(5)
+        def _invoke_chain():
+            if self.rate_limiter is not None:
+                self.rate_limiter.acquire()
+            return self.chain.invoke({
+                "system_message":self.system_message,
+                "base64_image":base64_image,
+                "features":features,
+            })
+
+        output_list = self.retry_policy.call(_invoke_chain, label=f"Template({os.path.basename(image_path)})")
         
         cleaned_list = []
         for output in output_list:
@@ -105,14 +142,8 @@ class KnowledgeBaseTemplateChain(SimpleLLM):
                     value = self._clean_with_regex(value)
                 cleaned_output[key] = value
             cleaned_list.append(cleaned_output)
-        
-        return {
-            "part_type": features["part_type"],
-            "classification": features["classification"],
-            "dimension_details": cleaned_list,
-            "metadata": {
-                "blueprint":os.path.basename(image_path), 
-                "ori_features":json.dumps(features, ensure_ascii=False)
-            }
-        }
+
+        if cache_key is not None:
+            self.template_cache.put(cache_key, image_hash, cleaned_list)
+        return self._make_template(image_path, features, cleaned_list)
     
\ No newline at end of file
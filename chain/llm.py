@@ -1,13 +1,332 @@
 import time
-from typing import Literal
+import queue
+import asyncio
+import random
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, as_completed
+from typing import Literal, Callable
+from email.utils import parsedate_to_datetime
 from langchain_core.runnables import Runnable
 
+from chain.router import BackendHealth
+
+class RetryPolicy:
+    """Exponential backoff with full jitter, capped, that only retries transient errors."""
+
+    RETRYABLE_STATUS = {408, 409, 425, 429, 500, 502, 503, 504, 529}
+    FATAL_STATUS = {400, 401, 403, 404, 405, 413, 422}
+    RETRYABLE_NAMES = (
+        "RateLimitError", "ResourceExhausted", "TooManyRequests",
+        "APITimeoutError", "DeadlineExceeded", "Timeout", "TimeoutException",
+        "APIConnectionError", "ServiceUnavailable", "InternalServerError",
+        "OverloadedError",
+    )
+    FATAL_NAMES = (
+        "AuthenticationError", "PermissionDenied", "PermissionDeniedError",
+        "Unauthenticated", "BadRequestError", "InvalidArgument",
+        "NotFoundError", "NotFound", "UnprocessableEntityError",
+    )
+
+    def __init__(
+        self,
+        retry_count:int = 3,
+        base_delay:float = 1.0,
+        max_delay:float = 30.0,
+        jitter:bool = True,
+        max_retry_after:float = 120.0,
+    ):
+        self.retry_count = retry_count
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.jitter = jitter
+        self.max_retry_after = max_retry_after
+        self.last_stats = None
+
+    def _get_status_code(self, error:Exception):
+        for holder in (error, getattr(error, "response", None)):
+            if holder is None:
+                continue
+            for attr in ("status_code", "code", "status"):
+                status = getattr(holder, attr, None)
+                if callable(status):
+                    try:
+                        status = status()
+                    except Exception:
+                        status = None
+                status = getattr(status, "value", status)
+                if isinstance(status, int) and 100 <= status < 600:
+                    return status
+        return None
+
+    def is_retryable(self, error:Exception) -> bool:
+        status = self._get_status_code(error)
+        if status in self.RETRYABLE_STATUS:
+            return True
+        if status in self.FATAL_STATUS:
+            return False
+
+        names = [cls.__name__ for cls in type(error).__mro__]
+        if any(name in self.FATAL_NAMES for name in names):
+            return False
+        if any(name in self.RETRYABLE_NAMES for name in names):
+            return True
+        if isinstance(error, (TimeoutError, ConnectionError)):
+            return True
+        if status is not None and status >= 500:
+            return True
+        # Unknown errors (e.g. a malformed tool call) keep the old retry-everything behaviour.
+        return status is None
+
+    def get_retry_after(self, error:Exception):
+        response = getattr(error, "response", None)
+        headers = getattr(response, "headers", None)
+        if not headers:
+            return None
+        retry_after = headers.get("retry-after") or headers.get("Retry-After")
+        if retry_after is None:
+            return None
+        try:
+            return max(0.0, float(retry_after))
+        except ValueError:
+            pass
+        try:
+            return max(0.0, parsedate_to_datetime(retry_after).timestamp() - time.time())
+        except (TypeError, ValueError):
+            return None
+
+    def get_delay(self, attempt:int, error:Exception = None) -> float:
+        delay = min(self.max_delay, self.base_delay * (2 ** attempt))
+        if self.jitter:
+            delay = random.uniform(0, delay)
+        retry_after = self.get_retry_after(error) if error is not None else None
+        if retry_after is not None:
+            # The server's wait is honored in full; retrying earlier only earns another 429.
+            delay = max(delay, retry_after)
+        return delay
+
+    def exceeds_budget(self, delay:float) -> bool:
+        """A Retry-After longer than `max_retry_after` fails fast instead of blocking the request."""
+        return self.max_retry_after is not None and delay > self.max_retry_after
+
+    def call(self, fn:Callable, *args, label:str = "LLM", **kwargs):
+        started_at = time.monotonic()
+        for attempt in range(self.retry_count):
+            try:
+                output = fn(*args, **kwargs)
+                self.last_stats = {"retries": attempt, "elapsed": time.monotonic() - started_at}
+                return output
+            except Exception as e:
+                retryable = self.is_retryable(e)
+                if not retryable or attempt == self.retry_count - 1:
+                    self.last_stats = {"retries": attempt, "elapsed": time.monotonic() - started_at}
+                    print(
+                        f"{label} failed after {attempt + 1} attempt(s) "
+                        f"in {self.last_stats['elapsed']:.1f}s ({'retryable' if retryable else 'fatal'}): '{e}'"
+                    )
+                    raise
+                delay = self.get_delay(attempt, e)
+                if self.exceeds_budget(delay):
+                    self.last_stats = {"retries": attempt, "elapsed": time.monotonic() - started_at}
+                    print(f"{label} failed: server asked to wait {delay:.1f}s, over the retry budget: '{e}'")
+                    raise
+                print(f"Retry({attempt})... {label} error, waiting {delay:.1f}s cause '{e}'")
+                time.sleep(delay)
+
+    async def acall(self, fn:Callable, *args, label:str = "LLM", **kwargs):
+        started_at = time.monotonic()
+        for attempt in range(self.retry_count):
+            try:
+                output = await fn(*args, **kwargs)
+                self.last_stats = {"retries": attempt, "elapsed": time.monotonic() - started_at}
+                return output
+            except Exception as e:
+                retryable = self.is_retryable(e)
+                if not retryable or attempt == self.retry_count - 1:
+                    self.last_stats = {"retries": attempt, "elapsed": time.monotonic() - started_at}
+                    print(
+                        f"{label} failed after {attempt + 1} attempt(s) "
+                        f"in {self.last_stats['elapsed']:.1f}s ({'retryable' if retryable else 'fatal'}): '{e}'"
+                    )
+                    raise
+                delay = self.get_delay(attempt, e)
+                if self.exceeds_budget(delay):
+                    self.last_stats = {"retries": attempt, "elapsed": time.monotonic() - started_at}
+                    print(f"{label} failed: server asked to wait {delay:.1f}s, over the retry budget: '{e}'")
+                    raise
+                print(f"Retry({attempt})... {label} error, waiting {delay:.1f}s cause '{e}'")
+                await asyncio.sleep(delay)
+
+
+def get_restart_listener(args:tuple, kwargs:dict):
+    """`configurable.on_stream_restart` of the runnable config, called when a stream starts over."""
+    config = kwargs.get("config") or (args[1] if len(args) > 1 else None)
+    if not isinstance(config, dict):
+        return None
+    return (config.get("configurable") or {}).get("on_stream_restart")
+
+def notify_restart(listener):
+    if listener is not None:
+        listener()
+
+class ResilientStream:
+    """Token stream that retries and fails over when the provider breaks mid-stream.
+
+    If tokens were already emitted, the answer is regenerated from the start and
+    the restart is reported out of band through `on_stream_restart`, so callers
+    can drop the partial attempt and show `RESTART_NOTICE` themselves.
+    `close()` (alias `cancel()`) releases the underlying connection immediately.
+    """
+
+    RESTART_NOTICE = "\n\n_(Connection interrupted, regenerating the answer...)_\n\n"
+
+    def __init__(self, llm:"SimpleLLM", args:tuple, kwargs:dict):
+        self.llm = llm
+        self.args = args
+        self.kwargs = kwargs
+        self.restarts = 0
+        self.restart_listener = get_restart_listener(args, kwargs)
+        self.backend = None
+        self._iterator = None
+        self._generator = self._run()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return next(self._generator)
+
+    def _close_iterator(self):
+        close = getattr(self._iterator, "close", None)
+        if close is not None:
+            close()
+        self._iterator = None
+
+    def close(self):
+        self._generator.close()
+        self._close_iterator()
+
+    cancel = close
+
+    def _open(self, label:str, llm:Runnable):
+        """Start a backend stream and wait for its first chunk (time-to-first-token)."""
+        started_at = time.monotonic()
+        try:
+            iterator = iter(llm.stream(*self.args, **self.kwargs))
+            first = next(iterator, None)
+        except Exception:
+            self.llm.record(label, ok=False)
+            raise
+        self.llm.record(label, latency=time.monotonic() - started_at, kind="ttft")
+        return iterator, first
+
+    def _open_hedged(self, backends:list):
+        """Race a second backend if the first has produced no token within the hedge delay."""
+        results = queue.Queue()
+
+        def _worker(label, llm):
+            try:
+                results.put((label, *self._open(label, llm), None))
+            except Exception as e:
+                results.put((label, None, None, e))
+
+        def _discard(pending:int):
+            for _ in range(pending):
+                _, iterator, _, _ = results.get()
+                close = getattr(iterator, "close", None)
+                if close is not None:
+                    close()
+
+        (label, llm, _), (hedge_label, hedge_llm, _) = backends[:2]
+        threading.Thread(target=_worker, args=(label, llm), daemon=True).start()
+        try:
+            outcome = results.get(timeout=self.llm.get_hedge_delay(label, kind="ttft"))
+            started = 1
+        except queue.Empty:
+            print(f"{label} slow to first token, hedging with {hedge_label}")
+            threading.Thread(target=_worker, args=(hedge_label, hedge_llm), daemon=True).start()
+            outcome = results.get()
+            started = 2
+
+        if outcome[3] is not None and started == 2:
+            outcome = results.get()
+            started = 1
+        if started == 2:
+            threading.Thread(target=_discard, args=(1,), daemon=True).start()
+
+        label, iterator, first, error = outcome
+        if error is not None:
+            raise error
+        return label, iterator, first
+
+    def _stream_from(self, label:str, iterator, first):
+        self.backend = label
+        self._iterator = iterator
+        if first is not None:
+            yield first
+        for chunk in iterator:
+            yield chunk
+
+    def _run(self):
+        last_error = None
+        backends = self.llm.get_backends(kind="ttft")
+        try:
+            if self.llm.hedge and len(backends) > 1:
+                emitted = False
+                try:
+                    for chunk in self._stream_from(*self._open_hedged(backends)):
+                        emitted = True
+                        yield chunk
+                    return
+                except Exception as e:
+                    self._close_iterator()
+                    last_error = e
+                    if emitted:
+                        self.restarts += 1
+                        notify_restart(self.restart_listener)
+
+            for label, llm, retry_policy in backends:
+                for attempt in range(retry_policy.retry_count):
+                    emitted = False
+                    try:
+                        for chunk in self._stream_from(label, *self._open(label, llm)):
+                            emitted = True
+                            yield chunk
+                        return
+                    except Exception as e:
+                        self._close_iterator()
+                        last_error = e
+                        if emitted:
+                            self.llm.record(label, ok=False)
+                            self.restarts += 1
+                            notify_restart(self.restart_listener)
+                        if not retry_policy.is_retryable(e):
+                            print(f"{label} stream failed (fatal): '{e}'")
+                            break
+                        if attempt < retry_policy.retry_count - 1:
+                            delay = retry_policy.get_delay(attempt, e)
+                            if retry_policy.exceeds_budget(delay):
+                                print(f"{label} asked to wait {delay:.1f}s, over the retry budget")
+                                break
+                            print(f"Retry({attempt})... {label} stream error, waiting {delay:.1f}s cause '{e}'")
+                            time.sleep(delay)
+                print(f"{label} stream gave up, trying next backend")
+            raise last_error
+        finally:
+            self._close_iterator()
+
+
 class SimpleLLM(Runnable):
     def __init__(
-            self, 
-            llm_type:Literal["google", "openai", "anthropic"], 
+            self,
+            llm_type:Literal["google", "openai", "anthropic"],
             model_name:str = None,
-            retry_count:int = 3
+            retry_count:int = 3,
+            retry_policy:RetryPolicy = None,
+            fallback:"SimpleLLM" = None,
+            routing:bool = False,
+            hedge:bool = False,
+            hedge_delay:float = 2.0,
+            health:BackendHealth = None,
         ):
         if llm_type == "google":
             from langchain_google_genai import ChatGoogleGenerativeAI
@@ -28,26 +347,244 @@ class SimpleLLM(Runnable):
             else:
                 llm = ChatAnthropic(model=model_name, temperature=0)
         self.llm = llm
+        self.llm_type = llm_type
+        self.label = f"{llm_type}:{getattr(llm, 'model', None) or getattr(llm, 'model_name', None)}"
         self.retry_count = retry_count
-        
+        self.retry_policy = retry_policy if retry_policy is not None else RetryPolicy(retry_count=retry_count)
+        self.fallback = fallback
+        self.routing = routing
+        self.hedge = hedge
+        self.hedge_delay = hedge_delay
+        if health is None and (routing or hedge):
+            health = BackendHealth()
+        self.health = health
+
+    def get_backends(self, kind:str = "total"):
+        backends = [(self.label, self.llm, self.retry_policy)]
+        if self.fallback is not None:
+            backends.extend(self.fallback.get_backends(kind=kind))
+        if self.routing:
+            backends = self.health.rank(backends, kind=kind)
+        return backends
+
+    def record(self, label:str, latency:float = None, ok:bool = True, kind:str = "total"):
+        if self.health is not None:
+            self.health.record(label, latency=latency, ok=ok, kind=kind)
+
+    def get_hedge_delay(self, label:str, kind:str = "total") -> float:
+        # Hedge once the primary is slower than its own p95; fixed delay until there is history.
+        p95 = self.health.latency_quantile(label, 0.95, kind=kind) if self.health is not None else None
+        return p95 if p95 is not None else self.hedge_delay
+
+    def _timed_invoke(self, label:str, llm:Runnable, retry_policy:RetryPolicy, *args, **kwargs):
+        started_at = time.monotonic()
+        try:
+            output = retry_policy.call(llm.invoke, *args, label=label, **kwargs)
+        except Exception:
+            self.record(label, ok=False)
+            raise
+        self.record(label, latency=time.monotonic() - started_at)
+        return output
+
+    def _hedged_invoke(self, backends:list, *args, **kwargs):
+        executor = ThreadPoolExecutor(max_workers=2)
+        try:
+            label = backends[0][0]
+            futures = [executor.submit(self._timed_invoke, *backends[0], *args, **kwargs)]
+            done, _ = wait(futures, timeout=self.get_hedge_delay(label))
+            if len(done) == 0:
+                print(f"{label} slow to answer, hedging with {backends[1][0]}")
+                futures.append(executor.submit(self._timed_invoke, *backends[1], *args, **kwargs))
+
+            last_error = None
+            for future in as_completed(futures):
+                try:
+                    return future.result()
+                except Exception as e:
+                    last_error = e
+            raise last_error
+        finally:
+            # Do not block on the losing request.
+            executor.shutdown(wait=False)
+
     def invoke(self, *args, **kwargs):
-        for retry_idx in range(self.retry_count):
+        backends = self.get_backends()
+        last_error = None
+        if self.hedge and len(backends) > 1:
             try:
-                output = self.llm.invoke(*args, **kwargs)
-                break
-            except:
-                print(f"Retry({retry_idx})... Google API somethig wrong!")
-                time.sleep(5)
-        return output
-    
+                return self._hedged_invoke(backends, *args, **kwargs)
+            except Exception as e:
+                last_error = e
+            backends = backends[2:]
+
+        for backend in backends:
+            try:
+                return self._timed_invoke(*backend, *args, **kwargs)
+            except Exception as e:
+                last_error = e
+        raise last_error
+
     def stream(self, *args, **kwargs):
-        for retry_idx in range(self.retry_count):
+        return ResilientStream(self, args, kwargs)
+
+    async def _atimed_invoke(self, label:str, llm:Runnable, retry_policy:RetryPolicy, *args, **kwargs):
+        started_at = time.monotonic()
+        try:
+            output = await retry_policy.acall(llm.ainvoke, *args, label=label, **kwargs)
+        except Exception:
+            self.record(label, ok=False)
+            raise
+        self.record(label, latency=time.monotonic() - started_at)
+        return output
+
+    async def _ahedged_invoke(self, backends:list, *args, **kwargs):
+        label = backends[0][0]
+        tasks = [asyncio.ensure_future(self._atimed_invoke(*backends[0], *args, **kwargs))]
+        try:
+            done, _ = await asyncio.wait(tasks, timeout=self.get_hedge_delay(label))
+            if len(done) == 0:
+                print(f"{label} slow to answer, hedging with {backends[1][0]}")
+                tasks.append(asyncio.ensure_future(self._atimed_invoke(*backends[1], *args, **kwargs)))
+
+            last_error = None
+            for future in asyncio.as_completed(tasks):
+                try:
+                    return await future
+                except Exception as e:
+                    last_error = e
+            raise last_error
+        finally:
+            # Unlike threads, the losing request can actually be cancelled.
+            for task in tasks:
+                task.cancel()
+
+    async def ainvoke(self, *args, **kwargs):
+        backends = self.get_backends()
+        last_error = None
+        if self.hedge and len(backends) > 1:
+            try:
+                return await self._ahedged_invoke(backends, *args, **kwargs)
+            except Exception as e:
+                last_error = e
+            backends = backends[2:]
+
+        for backend in backends:
             try:
-                return self.llm.stream(*args, **kwargs)
-            except:
-                print(f"Retry({retry_idx})... Google API somethig wrong!")
-                time.sleep(5)
-    
+                return await self._atimed_invoke(*backend, *args, **kwargs)
+            except Exception as e:
+                last_error = e
+        raise last_error
+
+    @staticmethod
+    async def _aclose(iterator):
+        if iterator is not None:
+            try:
+                await iterator.aclose()
+            except RuntimeError:
+                # Already torn down by a cancelled __anext__.
+                pass
+
+    async def _aopen(self, label:str, llm:Runnable, args:tuple, kwargs:dict):
+        """Async counterpart of ResilientStream._open."""
+        started_at = time.monotonic()
+        iterator = llm.astream(*args, **kwargs)
+        try:
+            first = await iterator.__anext__()
+        except StopAsyncIteration:
+            first = None
+        except asyncio.CancelledError:
+            await self._aclose(iterator)
+            raise
+        except Exception:
+            self.record(label, ok=False)
+            await self._aclose(iterator)
+            raise
+        self.record(label, latency=time.monotonic() - started_at, kind="ttft")
+        return label, iterator, first
+
+    async def _aopen_hedged(self, backends:list, args:tuple, kwargs:dict):
+        """Race a second backend if the first has produced no token within the hedge delay."""
+        (label, llm, _), (hedge_label, hedge_llm, _) = backends[:2]
+        tasks = [asyncio.ensure_future(self._aopen(label, llm, args, kwargs))]
+        winner = None
+        try:
+            done, _ = await asyncio.wait(tasks, timeout=self.get_hedge_delay(label, kind="ttft"))
+            if len(done) == 0:
+                print(f"{label} slow to first token, hedging with {hedge_label}")
+                tasks.append(asyncio.ensure_future(self._aopen(hedge_label, hedge_llm, args, kwargs)))
+
+            last_error = None
+            for future in asyncio.as_completed(tasks):
+                try:
+                    winner = await future
+                    return winner
+                except Exception as e:
+                    last_error = e
+            raise last_error
+        finally:
+            for task in tasks:
+                if not task.done():
+                    task.cancel()
+                elif not task.cancelled() and task.exception() is None and task.result() is not winner:
+                    await self._aclose(task.result()[1])
+
+    async def astream(self, *args, **kwargs):
+        """Async counterpart of ResilientStream: hedges, retries, fails over and reports restarts."""
+        restart_listener = get_restart_listener(args, kwargs)
+        last_error = None
+        backends = self.get_backends(kind="ttft")
+        if self.hedge and len(backends) > 1:
+            emitted = False
+            iterator = None
+            try:
+                label, iterator, first = await self._aopen_hedged(backends, args, kwargs)
+                if first is not None:
+                    emitted = True
+                    yield first
+                async for chunk in iterator:
+                    yield chunk
+                return
+            except Exception as e:
+                last_error = e
+                if emitted:
+                    notify_restart(restart_listener)
+            finally:
+                await self._aclose(iterator)
+
+        for label, llm, retry_policy in backends:
+            for attempt in range(retry_policy.retry_count):
+                emitted = False
+                iterator = None
+                try:
+                    label, iterator, first = await self._aopen(label, llm, args, kwargs)
+                    if first is not None:
+                        emitted = True
+                        yield first
+                    async for chunk in iterator:
+                        yield chunk
+                    return
+                except Exception as e:
+                    last_error = e
+                    if emitted:
+                        self.record(label, ok=False)
+                        notify_restart(restart_listener)
+                    if not retry_policy.is_retryable(e):
+                        print(f"{label} stream failed (fatal): '{e}'")
+                        break
+                    if attempt < retry_policy.retry_count - 1:
+                        delay = retry_policy.get_delay(attempt, e)
+                        if retry_policy.exceeds_budget(delay):
+                            print(f"{label} asked to wait {delay:.1f}s, over the retry budget")
+                            break
+                        print(f"Retry({attempt})... {label} stream error, waiting {delay:.1f}s cause '{e}'")
+                        await asyncio.sleep(delay)
+                finally:
+                    await self._aclose(iterator)
+            print(f"{label} stream gave up, trying next backend")
+        raise last_error
+
     def bind_tools(self, *args, **kwargs):
         self.llm = self.llm.bind_tools(*args, **kwargs)
+        if self.fallback is not None:
+            self.fallback.bind_tools(*args, **kwargs)
         return self
@@ -0,0 +1,87 @@
+from typing import List
+from langchain_core.documents import Document
+
+from utils import json_loads, estimate_tokens
+
+class ContextPacker:
+    """Renders retrieved documents as compact per-template tables for the answer prompt.
+
+    Documents sharing a classification and dimension schema become one table with
+    the dimension names/descriptions stated once, duplicate rows are dropped and
+    rows are added in retrieval order until the token budget is used up.
+    """
+
+    def __init__(self, max_tokens:int = 1500, max_desc_chars:int = 120):
+        self.max_tokens = max_tokens
+        self.max_desc_chars = max_desc_chars
+
+    def _parse(self, doc:Document):
+        try:
+            content = json_loads(doc.page_content)
+        except (TypeError, ValueError):
+            return None
+        if not isinstance(content, dict) or "dimension_details" not in content:
+            return None
+        return content
+
+    def _format_value(self, value):
+        if isinstance(value, float) and value.is_integer():
+            return str(int(value))
+        return str(value)
+
+    def _render_header(self, classification:str, dim_details:List[dict]):
+        lines = [f"## {classification}"]
+        for cur in dim_details:
+            desc = str(cur.get("desc", ""))
+            if len(desc) > self.max_desc_chars:
+                desc = desc[:self.max_desc_chars].rstrip() + "..."
+            lines.append(f"- {cur['alphabet']}: {cur.get('name', '')}. {desc}".rstrip())
+        lines.append("part_type | " + " | ".join(cur["alphabet"] for cur in dim_details))
+        return "\n".join(lines)
+
+    def pack(self, docs:List[Document]) -> str:
+        groups = {}   # (classification, alphabets) -> {"header": str, "rows": {values: [part_type]}}
+        raw = []
+        used_tokens = 0
+
+        for doc in docs:
+            content = self._parse(doc)
+            if content is None:
+                text = doc.page_content
+                if used_tokens + estimate_tokens(text) > self.max_tokens and (groups or raw):
+                    break
+                raw.append(text)
+                used_tokens += estimate_tokens(text)
+                continue
+
+            dim_details = content["dimension_details"]
+            alphabets = tuple(cur["alphabet"] for cur in dim_details)
+            values = tuple(self._format_value(cur.get("value")) for cur in dim_details)
+            part_type = str(content.get("part_type"))
+            key = (content.get("classification"), alphabets)
+
+            # Variants with identical dimensions share one row.
+            group = groups.get(key)
+            if group is not None and values in group["rows"]:
+                if part_type not in group["rows"][values]:
+                    group["rows"][values].append(part_type)
+                    used_tokens += estimate_tokens(part_type)
+                continue
+
+            cost = estimate_tokens(part_type + " | " + " | ".join(values))
+            if group is None:
+                header = self._render_header(content.get("classification"), dim_details)
+                cost += estimate_tokens(header)
+            if used_tokens + cost > self.max_tokens and (groups or raw):
+                break
+
+            if group is None:
+                group = groups[key] = {"header": header, "rows": {}}
+            group["rows"][values] = [part_type]
+            used_tokens += cost
+
+        sections = []
+        for group in groups.values():
+            rows = [", ".join(part_types) + " | " + " | ".join(values) for values, part_types in group["rows"].items()]
+            sections.append(group["header"] + "\n" + "\n".join(rows))
+        return "\n\n".join(sections + raw)
@@ -0,0 +1,38 @@
+import time
+import threading
+
+class TokenBucketRateLimiter:
+    """Thread-safe token bucket. `acquire` blocks until a request may be sent."""
+
+    def __init__(self, requests_per_minute:float, burst:int = 1):
+        self.rate = requests_per_minute / 60.0
+        self.capacity = max(1, burst)
+        self.tokens = float(self.capacity)
+        self.updated_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def acquire(self, tokens:float = 1.0):
+        while True:
+            with self._lock:
+                self._refill()
+                if self.tokens >= tokens:
+                    self.tokens -= tokens
+                    return
+                wait = (tokens - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+RATE_LIMITERS = {}
+_RATE_LIMITERS_LOCK = threading.Lock()
+
+def get_rate_limiter(provider:str, requests_per_minute:float = 60, burst:int = 1) -> TokenBucketRateLimiter:
+    """One shared bucket per provider so every caller stays inside the same quota."""
+    with _RATE_LIMITERS_LOCK:
+        if provider not in RATE_LIMITERS:
+            RATE_LIMITERS[provider] = TokenBucketRateLimiter(requests_per_minute, burst)
+        return RATE_LIMITERS[provider]
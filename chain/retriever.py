@@ -1,16 +1,29 @@
 import os
+import re
 import json
-import copy
+import time
 import hashlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
 
-from typing import List, Dict, Literal, Any
+from typing import List, Dict, Literal, Any, Optional, Iterable
 from chromadb.api import ClientAPI
 from chromadb.config import Settings
 from langchain.pydantic_v1 import BaseModel, Field
 from langchain_core.documents import Document
 from langchain_chroma import Chroma
 from langchain_community.retrievers import TavilySearchAPIRetriever
-from langchain_core.vectorstores.base import VectorStoreRetriever
+from langchain_core.callbacks import (
+    AsyncCallbackManagerForRetrieverRun,
+    CallbackManagerForRetrieverRun,
+)
+from langchain_core.runnables.config import run_in_executor
+from langchain_core.retrievers import BaseRetriever
+
+from chain.embedding import CachedEmbeddings
+from chain.index import BM25Index, NumericRangeIndex, RangeQueryPlanner
+from chain.template import CompiledTemplate
 
 class WebsearchRetriever(TavilySearchAPIRetriever):
 
@@ -27,8 +40,129 @@ class WebsearchRetriever(TavilySearchAPIRetriever):
             description="Obtaining additional information by searching the web."
         )
 
+class FamilyFilteredRetriever(BaseRetriever):
+    """Vector search narrowed by a `where` filter on the part family found in the question."""
+    vectorstore: Any
+    k: int = 4
+    score_threshold: Optional[float] = None
+
+    def _search(self, query:str) -> List[Document]:
+        where = self.vectorstore.detect_family_filter(query)
+        if self.score_threshold is None:
+            return self.vectorstore.similarity_search(query, k=self.k, filter=where)
+        docs_and_scores = self.vectorstore.similarity_search_with_relevance_scores(
+            query, k=self.k, filter=where, score_threshold=self.score_threshold
+        )
+        return [doc for doc, _ in docs_and_scores]
+
+    def _get_relevant_documents(
+        self, query: str, *, run_manager: CallbackManagerForRetrieverRun
+    ) -> List[Document]:
+        return self._search(query)
+
+    async def _aget_relevant_documents(
+        self, query: str, *, run_manager: AsyncCallbackManagerForRetrieverRun
+    ) -> List[Document]:
+        return await run_in_executor(None, self._search, query)
+
+class HybridRetriever(BaseRetriever):
+    """Fuses BM25 and vector results with reciprocal-rank fusion."""
+    vectorstore: Any
+    retriever: BaseRetriever
+    k: int = 10
+    rrf_k: int = 60
+    use_family_filter: bool = False
+
+    def _lexical_search(self, query:str) -> List[tuple]:
+        # Same family pre-filter as the vector half, so fusion cannot bring other families back.
+        families = self.vectorstore.detect_families(query) if self.use_family_filter else None
+        return self.vectorstore.lexical_search(query, k=self.k, families=families)
+
+    def _fuse(self, vector_docs:List[Document], lexical:List[tuple]) -> List[Document]:
+        scores, docs_by_id = {}, {}
+        for rank, doc in enumerate(vector_docs):
+            doc_id = doc.metadata.get("id")
+            if doc_id is None:
+                continue
+            docs_by_id[doc_id] = doc
+            scores[doc_id] = scores.get(doc_id, 0.0) + 1.0 / (self.rrf_k + rank + 1)
+        for rank, (doc_id, _) in enumerate(lexical):
+            scores[doc_id] = scores.get(doc_id, 0.0) + 1.0 / (self.rrf_k + rank + 1)
+
+        top_ids = sorted(scores, key=scores.get, reverse=True)[:self.k]
+        missing = [doc_id for doc_id in top_ids if doc_id not in docs_by_id]
+        if missing:
+            stored = self.vectorstore.get(ids=missing, include=["documents", "metadatas"])
+            for doc_id, page_content, metadata in zip(stored["ids"], stored["documents"], stored["metadatas"]):
+                docs_by_id[doc_id] = Document(page_content=page_content, metadata=metadata)
+        return [docs_by_id[doc_id] for doc_id in top_ids if doc_id in docs_by_id]
+
+    def _get_relevant_documents(
+        self, query: str, *, run_manager: CallbackManagerForRetrieverRun
+    ) -> List[Document]:
+        vector_docs = self.retriever.invoke(query, config={"callbacks": run_manager.get_child()})
+        lexical = self._lexical_search(query)
+        return self._fuse(vector_docs, lexical)
+
+    async def _aget_relevant_documents(
+        self, query: str, *, run_manager: AsyncCallbackManagerForRetrieverRun
+    ) -> List[Document]:
+        vector_docs = await self.retriever.ainvoke(query, config={"callbacks": run_manager.get_child()})
+        lexical = await run_in_executor(None, self._lexical_search, query)
+        return await run_in_executor(None, self._fuse, vector_docs, lexical)
+
+class RangeAwareRetriever(BaseRetriever):
+    """Answers numeric range questions from the range index, falls back to vector search."""
+    vectorstore: Any
+    retriever: BaseRetriever
+    k: int = 10
+    use_family_filter: bool = False
+
+    def _range_search(self, query:str) -> set:
+        ids = self.vectorstore.range_search(query)
+        if ids and self.use_family_filter:
+            families = self.vectorstore.detect_families(query)
+            if families:
+                ids = ids & self.vectorstore.get_family_ids(families)
+        return ids
+
+    def _get_relevant_documents(
+        self, query: str, *, run_manager: CallbackManagerForRetrieverRun
+    ) -> List[Document]:
+        ids = self._range_search(query)
+        if not ids:
+            return self.retriever.invoke(query, config={"callbacks": run_manager.get_child()})
+
+        # Rank only the exact shortlist by similarity instead of the whole collection.
+        return self.vectorstore.similarity_search(
+            query, k=self.k, filter={"id": {"$in": list(ids)}}
+        )
+
+    async def _aget_relevant_documents(
+        self, query: str, *, run_manager: AsyncCallbackManagerForRetrieverRun
+    ) -> List[Document]:
+        ids = await run_in_executor(None, self._range_search, query)
+        if not ids:
+            return await self.retriever.ainvoke(query, config={"callbacks": run_manager.get_child()})
+
+        return await self.vectorstore.asimilarity_search(
+            query, k=self.k, filter={"id": {"$in": list(ids)}}
+        )
+
 class DocRetrieverManager(Chroma):
 
+    # English family words in (rewritten) questions -> top-level classification used in the catalog.
+    FAMILY_ALIASES = {
+        "bolt": "볼트",
+        "nut": "너트",
+        "screw": "나사",
+        "washer": "와셔",
+        "pin": "핀",
+        "rivet": "리벳",
+        "spring": "스프링",
+        "bearing": "베어링",
+    }
+
     class ToolSchema(BaseModel):
         query:str = Field(description="Query to accurately search for the manufacturing parts the user is looking for")
 
@@ -40,7 +174,8 @@ class DocRetrieverManager(Chroma):
         persist_directory: str | None = None, 
         client_settings: Settings | None = None, 
         collection_metadata: Dict | None = None, 
-        client: ClientAPI | None = None
+        client: ClientAPI | None = None,
+        embedding_cache_path: str | None = None,
     ) -> None:
         
         if model_type == "google":
@@ -56,6 +191,15 @@ class DocRetrieverManager(Chroma):
             else:
                 emb_model = OpenAIEmbeddings(model=model_name)
 
+        if embedding_cache_path is None and persist_directory is not None:
+            embedding_cache_path = os.path.join(persist_directory, "embedding_cache.sqlite")
+        if embedding_cache_path is not None:
+            emb_model = CachedEmbeddings(
+                emb_model,
+                model_name=f"{model_type}/{emb_model.model}",
+                cache_path=embedding_cache_path
+            )
+
         super().__init__(
             collection_name=collection_name,
             embedding_function=emb_model,
@@ -64,6 +208,11 @@ class DocRetrieverManager(Chroma):
             collection_metadata=collection_metadata,
             client=client
         )
+        self.numeric_index = None
+        self.lexical_index = None
+        self.family_ids = None  # classification_l1 -> ids, for family pre-filtering local indexes
+        self.indexed_count = None  # collection count the local indexes were built from
+        self.collection_version = 0
 
     def _check_is_knowledgebase(self, inputs:List[dict]):
         for input in inputs:
@@ -79,10 +228,23 @@ class DocRetrieverManager(Chroma):
                 if not all(key in dim_detail for key in req_dim_detail_keys):
                     raise ValueError("Input['dimension_details'] is not valid for knowledgebase.")
             
+    def _to_classification_metadata(self, input:dict):
+        metadata = {}
+        if "part_type" in input:
+            metadata["part_type"] = str(input["part_type"])
+        if "classification" in input:
+            metadata["classification"] = str(input["classification"])
+            levels = [cur.strip() for cur in str(input["classification"]).split(">")]
+            for level, value in enumerate(levels, start=1):
+                metadata[f"classification_l{level}"] = value
+        return metadata
+
     def _to_document(self, inputs:List[dict]):
         docs = []
         for input in inputs:
             metadata = input.pop("metadata")
+            # Indexed fields let Chroma pre-filter by part family before the ANN search.
+            metadata.update(self._to_classification_metadata(input))
             page_content = json.dumps(input, ensure_ascii=False)
             doc = Document(page_content=page_content, metadata=metadata)
             docs.append(doc)
@@ -92,50 +254,10 @@ class DocRetrieverManager(Chroma):
         return hashlib.sha256(str(input).encode('utf-8')).hexdigest()
     
     def _check_feature_template_match(self, to_check_input:dict, template:dict):
-        to_check_input = to_check_input.copy()
-
-        eq_part_type = to_check_input["part_type"] == template["part_type"]
-        eq_classification = to_check_input["classification"] == template["classification"]
-        
-        to_check_input.pop("part_type")
-        to_check_input.pop("classification")
-        alphabet_list_in = set(to_check_input.keys())
-        alphabet_list_tp = set(cur["alphabet"] for cur in template["dimension_details"])
-        ok_alphabets = all(elem in alphabet_list_tp for elem in alphabet_list_in)
-
-        if all([eq_part_type, eq_classification, ok_alphabets]):
-            return True
-        else:
-            return False
+        return CompiledTemplate(template).matches(to_check_input)
 
     def _insert_feature_into_template(self, features:dict, template:dict, mode:Literal["safe", "greedy"]="safe"):
-        template = copy.deepcopy(template)
-
-        result = {}
-        for key, value in template.items():
-            if key == "dimension_details":
-                dimension_details = []
-                for cur in template[key]:
-                    if cur["alphabet"] not in features.keys():
-                        if mode == "safe":
-                            continue
-                        else:
-                            dimension_details.append(cur)
-                    else:
-                        dimension_details.append({
-                            'name': cur["name"],
-                            'value': features[cur["alphabet"]],
-                            'alphabet': cur["alphabet"],
-                            'desc': cur["desc"]
-                        })
-                result[key] = dimension_details
-            else:
-                if key in features.keys():
-                    result[key] = features[key]
-                else:
-                    result[key] = value
-        
-        return result
+        return CompiledTemplate(template).fill(features, mode=mode)
     
     def insert_feature_list_into_template(
         self, 
@@ -144,38 +266,252 @@ class DocRetrieverManager(Chroma):
         insert_mode:Literal["safe", "greedy"]="safe",
         check_template_matched:bool = True
     ):
-        formed_features_list = []
-        for features in features_list:
-            if check_template_matched == True:
-                if self._check_feature_template_match(features, template) == False:
-                    raise ValueError("Data features and generated template does not matched")
-            
-            formed_features = self._insert_feature_into_template(features, template, mode=insert_mode)
-            formed_features_list.append(formed_features)
-        
-        return formed_features_list
+        # Compiled once per blueprint, then every row is filled without copying the template.
+        return CompiledTemplate(template).fill_batch(
+            features_list, mode=insert_mode, check_template_matched=check_template_matched
+        )
 
-    def insert_dict(self, inputs:List[dict], check_is_kb:bool=True):
-        
+    def make_id(self, part_type:str, classification:str, ori_features:str):
+        return self._generate_sha256_id([part_type, classification, ori_features])
+
+    def get_existing_ids(self, ids:List[str]) -> set:
+        if len(ids) == 0:
+            return set()
+        return set(self.get(ids=ids, include=[])["ids"])
+
+    def _prepare_documents(self, inputs:List[dict], check_is_kb:bool=True):
+        ids = None
         if check_is_kb == True:
             self._check_is_knowledgebase(inputs)
-            ids = [self._generate_sha256_id(
-                    [input["part_type"], 
+            ids = [self.make_id(
+                    input["part_type"], 
                     input["classification"], 
-                    input["metadata"]["ori_features"]]
+                    input["metadata"]["ori_features"]
                  ) for input in inputs]
             for input, id in zip(inputs, ids):
                 input["metadata"]["id"] = id
-        docs = self._to_document(inputs)
+        return ids, self._to_document(inputs)
+
+    def _on_documents_added(self, ids:List[str], docs:List[Document]):
+        self.collection_version += 1
+
+        if self.numeric_index is not None:
+            self.numeric_index.add_documents(ids, [doc.page_content for doc in docs])
+        if self.lexical_index is not None:
+            self.lexical_index.add_documents(ids, [self._to_lexical_text(doc.page_content, doc.metadata) for doc in docs])
+        if self.family_ids is not None:
+            for doc_id, doc in zip(ids, docs):
+                if "classification_l1" in doc.metadata:
+                    self.family_ids.setdefault(doc.metadata["classification_l1"], set()).add(doc_id)
+            # Our own writes are already in the indexes; only foreign ones should force a rebuild.
+            self.indexed_count = self._collection.count()
+
+    def remove_documents(self, ids:List[str]):
+        if len(ids) == 0:
+            return
+        self.delete(ids=ids)
+        self.collection_version += 1
+        # The in-process indexes are rebuilt from the collection on next use.
+        self.numeric_index, self.lexical_index, self.family_ids = None, None, None
+
+    def insert_dict(self, inputs:List[dict], check_is_kb:bool=True):
+        ids, docs = self._prepare_documents(inputs, check_is_kb=check_is_kb)
         
         if check_is_kb == True:
-            self.add_documents(docs, ids=ids)
+            ids = self.add_documents(docs, ids=ids)
         else:
-            self.add_documents(docs)
+            ids = self.add_documents(docs)
+
+        self._on_documents_added(ids, docs)
+
+    def _get_max_upsert_size(self):
+        get_max_batch_size = getattr(self._client, "get_max_batch_size", None)
+        return get_max_batch_size() if get_max_batch_size is not None else 5000
+
+    def _embed_batch(self, batch:List[dict], check_is_kb:bool):
+        ids, docs = self._prepare_documents(batch, check_is_kb=check_is_kb)
+        if ids is None:
+            ids = [self._generate_sha256_id(doc.page_content) for doc in docs]
+        embeddings = self.embeddings.embed_documents([doc.page_content for doc in docs])
+        return ids, docs, embeddings
+
+    def _upsert_batch(self, ids:List[str], docs:List[Document], embeddings:List[List[float]]):
+        max_upsert_size = self._get_max_upsert_size()
+        for start in range(0, len(ids), max_upsert_size):
+            end = start + max_upsert_size
+            self._collection.upsert(
+                ids=ids[start:end],
+                embeddings=embeddings[start:end],
+                metadatas=[doc.metadata for doc in docs[start:end]],
+                documents=[doc.page_content for doc in docs[start:end]],
+            )
+        self._on_documents_added(ids, docs)
+
+    def insert_dict_bulk(
+        self,
+        inputs:Iterable[dict],
+        batch_size:int = 100,
+        max_workers:int = 4,
+        check_is_kb:bool = True,
+    ) -> dict:
+        """Streaming ingest: embed batches concurrently, upsert them in Chroma-sized chunks.
+
+        Only `max_workers` batches are held in memory at once. A failing batch is
+        recorded with its ids and does not stop the rest of the load.
+        """
+        stats = {"batches": [], "inserted": 0, "failed_ids": []}
+        records = iter(inputs)
+
+        def _finish(batch_idx:int, batch_ids:List[str], future, started_at:float):
+            batch_stats = {"batch": batch_idx, "size": len(batch_ids), "inserted": 0, "error": None}
+            try:
+                ids, docs, embeddings = future.result()
+                self._upsert_batch(ids, docs, embeddings)
+                batch_stats["inserted"] = len(ids)
+                stats["inserted"] += len(ids)
+            except Exception as e:
+                batch_stats["error"] = f"{type(e).__name__}: {e}"
+                stats["failed_ids"].extend(batch_ids)
+                print(f"Batch({batch_idx}) failed cause '{e}'")
+            batch_stats["seconds"] = time.monotonic() - started_at
+            stats["batches"].append(batch_stats)
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            pending = deque()
+            batch_idx = 0
+            while True:
+                batch = list(islice(records, batch_size))
+                if len(batch) == 0:
+                    break
+                # Ids are taken before the worker consumes the records' metadata.
+                batch_ids = self._get_batch_ids(batch)
+                pending.append((batch_idx, batch_ids, executor.submit(self._embed_batch, batch, check_is_kb), time.monotonic()))
+                batch_idx += 1
+                # Chroma writes stay on this thread, in submission order.
+                if len(pending) >= max_workers:
+                    _finish(*pending.popleft())
+            while pending:
+                _finish(*pending.popleft())
+
+        return stats
+
+    def _get_batch_ids(self, batch:List[dict]) -> List[str]:
+        ids = []
+        for input in batch:
+            try:
+                ids.append(self.make_id(
+                    input["part_type"], input["classification"], input["metadata"]["ori_features"]
+                ))
+            except (KeyError, TypeError, AttributeError):
+                ids.append(None)
+        return ids
 
-    def as_retriever(self, **kwargs: Any) -> VectorStoreRetriever:
+    def get_collection_version(self):
+        # The count also catches inserts made by another process (e.g. add_data.py).
+        return (self._collection.count(), self.collection_version)
+
+    def _to_lexical_text(self, page_content:str, metadata:dict):
+        return " ".join([page_content] + [str(value) for value in (metadata or {}).values()])
+
+    def _load_indexes(self):
+        # One pass over the collection builds both in-process indexes.
+        stored = self.get(include=["documents", "metadatas"])
+        numeric_index, lexical_index = NumericRangeIndex(), BM25Index()
+        numeric_index.add_documents(stored["ids"], stored["documents"])
+        lexical_index.add_documents(
+            stored["ids"],
+            [self._to_lexical_text(*cur) for cur in zip(stored["documents"], stored["metadatas"])]
+        )
+        self.numeric_index, self.lexical_index = numeric_index, lexical_index
+        self.family_ids = {}
+        for doc_id, metadata in zip(stored["ids"], stored["metadatas"]):
+            if metadata and "classification_l1" in metadata:
+                self.family_ids.setdefault(metadata["classification_l1"], set()).add(doc_id)
+        self.indexed_count = len(stored["ids"])
+
+    def _ensure_indexes(self):
+        # Rebuild when another process (e.g. add_data.py) changed the collection size.
+        if self.numeric_index is None or self.get_collection_version()[0] != self.indexed_count:
+            self._load_indexes()
+
+    def get_numeric_index(self) -> NumericRangeIndex:
+        self._ensure_indexes()
+        return self.numeric_index
+
+    def get_lexical_index(self) -> BM25Index:
+        self._ensure_indexes()
+        return self.lexical_index
+
+    def lexical_search(self, query:str, k:int = 10, families:set = None) -> List[tuple]:
+        allowed_ids = self.get_family_ids(families) if families else None
+        return self.get_lexical_index().search(query, k=k, allowed_ids=allowed_ids)
+
+    def get_family_values(self) -> set:
+        self._ensure_indexes()
+        return set(self.family_ids)
+
+    def get_family_ids(self, families:set) -> set:
+        self._ensure_indexes()
+        return set().union(*(self.family_ids.get(family, set()) for family in families))
+
+    def detect_families(self, query:str) -> set:
+        family_values = self.get_family_values()
+        lowered = query.lower()
+        matched = set(family for family in family_values if family in query)
+        for alias, family in self.FAMILY_ALIASES.items():
+            if family in family_values and re.search(rf"\b{alias}s?\b", lowered):
+                matched.add(family)
+        return matched
+
+    def detect_family_filter(self, query:str) -> Optional[dict]:
+        matched = self.detect_families(query)
+        if len(matched) == 0:
+            return None
+        return {"classification_l1": {"$in": sorted(matched)}}
+
+    def range_search(self, query:str) -> set:
+        numeric_index = self.get_numeric_index()
+        predicates, families = RangeQueryPlanner(numeric_index).plan(query)
+        if len(predicates) == 0:
+            return set()
+        return numeric_index.search(predicates, families=families)
+
+    def _make_vector_retriever(self, use_family_filter:bool = False, **kwargs: Any) -> BaseRetriever:
+        search_type = kwargs.get("search_type", "similarity")
+        search_kwargs = kwargs.get("search_kwargs", {})
+        if use_family_filter == True and search_type in ("similarity", "similarity_score_threshold"):
+            return FamilyFilteredRetriever(
+                vectorstore=self,
+                k=search_kwargs.get("k", 4),
+                score_threshold=search_kwargs.get("score_threshold") if search_type == "similarity_score_threshold" else None
+            )
         return super().as_retriever(**kwargs)
 
+    def as_retriever(
+        self,
+        use_range_index:bool = False,
+        use_family_filter:bool = False,
+        **kwargs: Any
+    ) -> BaseRetriever:
+        if kwargs.get("search_type") == "hybrid":
+            search_kwargs = kwargs.get("search_kwargs", {})
+            vector_search_type = "similarity_score_threshold" if "score_threshold" in search_kwargs else "similarity"
+            retriever = HybridRetriever(
+                vectorstore=self,
+                retriever=self._make_vector_retriever(
+                    use_family_filter=use_family_filter, **{**kwargs, "search_type": vector_search_type}
+                ),
+                k=search_kwargs.get("k", 4),
+                use_family_filter=use_family_filter
+            )
+        else:
+            retriever = self._make_vector_retriever(use_family_filter=use_family_filter, **kwargs)
+
+        if use_range_index == True:
+            k = kwargs.get("search_kwargs", {}).get("k", 4)
+            return RangeAwareRetriever(vectorstore=self, retriever=retriever, k=k, use_family_filter=use_family_filter)
+        return retriever
+
     def as_tool(self, **kwargs):
         retriever = self.as_retriever(**kwargs)
         return retriever.as_tool(
@@ -0,0 +1,85 @@
+import time
+import threading
+from collections import deque
+from statistics import median, quantiles
+
+class BackendHealth:
+    """Rolling latency / error-rate window per LLM backend.
+
+    Backends are ranked by median latency plus a penalty per failed request in
+    the window, so a degrading provider is moved behind a healthy one. Latency
+    is kept per kind ("total" for full responses, "ttft" for time-to-first-token)
+    so streams and invocations are not compared on the same scale. Samples
+    older than `max_age` seconds expire, and a backend that got no traffic for
+    `probe_interval` seconds is put first once, so a demoted backend recovers.
+    """
+
+    def __init__(
+        self,
+        window:int = 50,
+        error_penalty:float = 10.0,
+        max_age:float = 300.0,
+        probe_interval:float = 60.0,
+    ):
+        self.window = window
+        self.error_penalty = error_penalty
+        self.max_age = max_age
+        self.probe_interval = probe_interval
+        self._latencies = {}  # (label, kind) -> deque of (time, latency)
+        self._outcomes = {}  # label -> deque of (time, ok)
+        self._last_used = {}  # label -> time of the last sample or probe
+        self._lock = threading.Lock()
+
+    def record(self, label:str, latency:float = None, ok:bool = True, kind:str = "total"):
+        now = time.monotonic()
+        with self._lock:
+            self._outcomes.setdefault(label, deque(maxlen=self.window)).append((now, ok))
+            if ok and latency is not None:
+                self._latencies.setdefault((label, kind), deque(maxlen=self.window)).append((now, latency))
+            self._last_used[label] = now
+
+    def _fresh(self, samples) -> list:
+        if self.max_age is None:
+            return [value for _, value in samples]
+        deadline = time.monotonic() - self.max_age
+        return [value for recorded_at, value in samples if recorded_at >= deadline]
+
+    def _get_latencies(self, label:str, kind:str) -> list:
+        with self._lock:
+            return self._fresh(self._latencies.get((label, kind), ()))
+
+    def error_rate(self, label:str) -> float:
+        with self._lock:
+            outcomes = self._fresh(self._outcomes.get(label, ()))
+        if len(outcomes) == 0:
+            return 0.0
+        return sum(1 for ok in outcomes if not ok) / len(outcomes)
+
+    def latency_quantile(self, label:str, q:float = 0.95, kind:str = "total"):
+        latencies = self._get_latencies(label, kind)
+        if len(latencies) == 0:
+            return None
+        if len(latencies) == 1:
+            return latencies[0]
+        return quantiles(latencies, n=100, method="inclusive")[min(98, max(0, int(q * 100) - 1))]
+
+    def score(self, label:str, kind:str = "total") -> float:
+        latencies = self._get_latencies(label, kind)
+        # Untried backends score 0 so they get sampled at least once.
+        latency = median(latencies) if latencies else 0.0
+        return latency + self.error_penalty * self.error_rate(label)
+
+    def rank(self, backends:list, kind:str = "total") -> list:
+        ranked = sorted(backends, key=lambda backend: self.score(backend[0], kind=kind))
+        if self.probe_interval is None:
+            return ranked
+
+        now = time.monotonic()
+        with self._lock:
+            for idx, backend in enumerate(ranked[1:], start=1):
+                last_used = self._last_used.get(backend[0])
+                if last_used is not None and now - last_used >= self.probe_interval:
+                    # One request probes the idle backend; the others stay behind for failover.
+                    self._last_used[backend[0]] = now
+                    return [backend] + ranked[:idx] + ranked[idx + 1:]
+        return ranked
@@ -0,0 +1,82 @@
+import copy
+from typing import List, Literal, Tuple
+
+import numpy as np
+
+class CompiledTemplate:
+    """Knowledge base template prepared once for filling many feature rows.
+
+    Dimension slots are looked up by alphabet and carry their name/desc, so a
+    row is filled by building fresh small dicts instead of deep-copying the
+    template. `to_columns` gives the slot values of a batch as a float matrix.
+    """
+
+    def __init__(self, template:dict):
+        self.template = template
+        self.part_type = template["part_type"]
+        self.classification = template["classification"]
+        # (alphabet, name, desc, original detail) in template order
+        self.slots = [
+            (cur["alphabet"], cur["name"], cur["desc"], cur)
+            for cur in template["dimension_details"]
+        ]
+        self.slot_index = {alphabet: idx for idx, (alphabet, _, _, _) in enumerate(self.slots)}
+        self.alphabets = frozenset(self.slot_index)
+        self.keys = list(template.keys())
+
+    def matches(self, features:dict) -> bool:
+        if features["part_type"] != self.part_type or features["classification"] != self.classification:
+            return False
+        return all(
+            key in self.alphabets for key in features
+            if key not in ("part_type", "classification")
+        )
+
+    def fill(self, features:dict, mode:Literal["safe", "greedy"] = "safe") -> dict:
+        result = {}
+        for key in self.keys:
+            if key == "dimension_details":
+                dimension_details = []
+                for alphabet, name, desc, cur in self.slots:
+                    if alphabet in features:
+                        dimension_details.append({
+                            'name': name,
+                            'value': features[alphabet],
+                            'alphabet': alphabet,
+                            'desc': desc
+                        })
+                    elif mode != "safe":
+                        dimension_details.append(dict(cur))
+                result[key] = dimension_details
+            elif key in features:
+                result[key] = features[key]
+            else:
+                # Shallow copy: documents pop and update their metadata dict on insert.
+                result[key] = copy.copy(self.template[key])
+        return result
+
+    def fill_batch(
+        self,
+        features_list:List[dict],
+        mode:Literal["safe", "greedy"] = "safe",
+        check_template_matched:bool = True
+    ) -> List[dict]:
+        if check_template_matched:
+            for features in features_list:
+                if not self.matches(features):
+                    raise ValueError("Data features and generated template does not matched")
+        return [self.fill(features, mode=mode) for features in features_list]
+
+    def to_columns(self, features_list:List[dict]) -> Tuple[List[str], np.ndarray]:
+        """Slot alphabets and a (rows, slots) float matrix; missing or non-numeric values are NaN."""
+        values = np.full((len(features_list), len(self.slots)), np.nan, dtype=np.float64)
+        for row, features in enumerate(features_list):
+            for key, value in features.items():
+                col = self.slot_index.get(key)
+                if col is None:
+                    continue
+                try:
+                    values[row, col] = float(value)
+                except (TypeError, ValueError):
+                    continue
+        return [alphabet for alphabet, _, _, _ in self.slots], values
@@ -1,39 +1,164 @@
 import os, json
-from typing import List, Dict, Literal, Union, Tuple
+from typing import List, Dict, Literal, Union, Tuple, Iterator, Iterable, Optional
 from PIL import Image
 from glob import glob
+import numpy as np
 import pandas as pd
+from utils import json_loads
+
+def _get_cache_path(data_path:str, cache_dir:str) -> str:
+    # Size and mtime identify a workbook revision without reading it.
+    stat = os.stat(data_path)
+    name = os.path.splitext(os.path.basename(data_path))[0]
+    return os.path.join(cache_dir, f"{name}-{stat.st_size}-{int(stat.st_mtime)}")
+
+def _read_cache_manifest(cache_path:str) -> Optional[dict]:
+    manifest_path = os.path.join(cache_path, "sheets.json")
+    if not os.path.exists(manifest_path):
+        return None
+    with open(manifest_path, "r", encoding="utf-8") as f:
+        manifest = json.load(f)
+    # Caches written before the schema was stored are rebuilt.
+    return manifest if isinstance(manifest, dict) else None
+
+def make_outerjoin_schema(sheet_dfs:Iterable[pd.DataFrame]) -> pd.DataFrame:
+    """Empty frame with the column order and dtypes `make_outerjoin_df` would produce.
+
+    Concatenating the first row of every sheet follows the same rules as the full
+    outer join (e.g. an int column missing from another sheet becomes float).
+    """
+    return pd.concat([sheet_df.iloc[:1] for sheet_df in sheet_dfs]).iloc[:0]
+
+def convert_workbook_to_cache(data_path:str, cache_dir:str) -> Optional[str]:
+    """Write every sheet once as Feather so later runs memory-map instead of parsing ODS/XLSX."""
+    try:
+        import pyarrow.feather as feather
+    except ImportError:
+        print("pyarrow is not installed, workbook cache disabled---")
+        return None
+
+    cache_path = _get_cache_path(data_path, cache_dir)
+    if _read_cache_manifest(cache_path) is not None:
+        return cache_path
+
+    os.makedirs(cache_path, exist_ok=True)
+    sheet_files, first_rows = [], []
+    for idx, (sheet_name, sheet_df) in enumerate(iter_sheets(data_path)):
+        sheet_file = f"{idx}.feather"
+        try:
+            feather.write_feather(sheet_df.reset_index(drop=True), os.path.join(cache_path, sheet_file))
+        except Exception as e:
+            print(f"Sheet '{sheet_name}' can not be cached, cause '{e}'---")
+            return None
+        sheet_files.append(sheet_file)
+        first_rows.append(sheet_df.iloc[:1])
+
+    # The outer-join schema is taken in the same pass, so reading never parses the workbook twice.
+    try:
+        feather.write_feather(pd.concat(first_rows).reset_index(drop=True), os.path.join(cache_path, "schema.feather"))
+    except Exception as e:
+        print(f"Workbook schema can not be cached, cause '{e}'---")
+        return None
+
+    with open(os.path.join(cache_path, "sheets.json"), "w", encoding="utf-8") as f:
+        json.dump({"sheets": sheet_files, "schema": "schema.feather"}, f)
+    return cache_path
+
+def read_cached_schema(cache_path:str) -> pd.DataFrame:
+    import pyarrow.feather as feather
+    schema_file = _read_cache_manifest(cache_path)["schema"]
+    return make_outerjoin_schema([feather.read_table(os.path.join(cache_path, schema_file)).to_pandas()])
+
+def iter_sheets(
+    data_path:str,
+    cache_dir:str = None
+) -> Iterator[Tuple[str, pd.DataFrame]]:
+    
+    if cache_dir is not None:
+        cache_path = convert_workbook_to_cache(data_path, cache_dir)
+        if cache_path is not None:
+            import pyarrow.feather as feather
+            for sheet_file in _read_cache_manifest(cache_path)["sheets"]:
+                table = feather.read_table(os.path.join(cache_path, sheet_file), memory_map=True)
+                yield sheet_file, table.to_pandas()
+            return
+
+    # One sheet in memory at a time instead of the whole workbook plus its concatenation.
+    with pd.ExcelFile(data_path) as workbook:
+        for sheet_name in workbook.sheet_names:
+            yield sheet_name, workbook.parse(sheet_name)
 
 def make_outerjoin_df(
-    data_path: str
+    data_path: str,
+    cache_dir: str = None
 ) -> pd.DataFrame:
     
-    df = pd.read_excel(data_path, sheet_name=None)
-    outerjoin_df = pd.concat([df[cur] for cur in df])
-    return outerjoin_df
+    return pd.concat([sheet_df for _, sheet_df in iter_sheets(data_path, cache_dir=cache_dir)])
+
+def _records_without_na(values, mask, columns:List[str], positions) -> List[dict]:
+    return [
+        {col: value for col, value, is_valid in zip(columns, values[pos], mask[pos]) if is_valid}
+        for pos in positions
+    ]
+
+def iter_features_from_df(
+    df:pd.DataFrame,
+    mode:Literal["unique", "all"] = "unique"
+) -> Iterator[Tuple[str, List[dict]]]:
+    
+    feature_cols = [col for col in df.columns if col != "bp"]
+    # One conversion for the whole frame; groups only index into it.
+    values = df[feature_cols].to_numpy(dtype=object)
+    mask = df[feature_cols].notna().to_numpy()
+    # Blueprints in order of first appearance, each with its row positions in original order.
+    codes, bp_names = pd.factorize(df["bp"], use_na_sentinel=False)
+    sorted_positions = np.argsort(codes, kind="stable")
+    bounds = np.cumsum(np.bincount(codes, minlength=len(bp_names)))[:-1]
+
+    for bp_name, positions in zip(bp_names, np.split(sorted_positions, bounds)):
+        if mode == "unique":
+            positions = positions[:1]
+        yield bp_name, _records_without_na(values, mask, feature_cols, positions)
 
 def get_features_from_df(
     df:pd.DataFrame,
     mode:Literal["unique", "all"] = "unique"
 ) -> Dict[str, List[dict]]:
     
-    features_per_bp = {}
+    return dict(iter_features_from_df(df, mode=mode))
+
+def iter_features_from_workbook(
+    data_path:str,
+    mode:Literal["unique", "all"] = "unique",
+    cache_dir:str = None
+) -> Iterator[Tuple[str, List[dict]]]:
+    """Yield blueprint features sheet by sheet; a blueprint split over sheets is yielded per sheet."""
+    # Values and key order must match the outer-joined frame, ids are derived from them.
+    cache_path = convert_workbook_to_cache(data_path, cache_dir) if cache_dir is not None else None
+    if cache_path is not None:
+        schema = read_cached_schema(cache_path)
+        sheet_dfs = (sheet_df for _, sheet_df in iter_sheets(data_path, cache_dir=cache_dir))
+    else:
+        # Without the cache every sheet is parsed once and kept until the schema is known.
+        sheet_dfs = [sheet_df for _, sheet_df in iter_sheets(data_path)]
+        schema = make_outerjoin_schema(sheet_dfs)
 
-    if mode == "unique":
-        bp_names = df["bp"].unique()
-        for bp_name in bp_names:
-            features = df[df["bp"] == bp_name].iloc[0].drop(["bp"]).dropna().to_dict()
-            features_per_bp[bp_name] = [features]
+    for sheet_df in sheet_dfs:
+        sheet_df = sheet_df.reindex(columns=schema.columns).astype(schema.dtypes.to_dict())
+        yield from iter_features_from_df(sheet_df, mode=mode)
+
+def get_features_from_workbook(
+    data_path:str,
+    mode:Literal["unique", "all"] = "unique",
+    cache_dir:str = None
+) -> Dict[str, List[dict]]:
     
-    else:  # mode == "all"
-        for _, row in df.iterrows():
-            bp_name = row["bp"]
-            features = row.drop(["bp"]).dropna().to_dict()
-            
-            if bp_name not in features_per_bp:
-                features_per_bp[bp_name] = []
-            features_per_bp[bp_name].append(features)
-        
+    features_per_bp = {}
+    for bp_name, features_list in iter_features_from_workbook(data_path, mode=mode, cache_dir=cache_dir):
+        if bp_name not in features_per_bp:
+            features_per_bp[bp_name] = features_list
+        elif mode == "all":
+            features_per_bp[bp_name].extend(features_list)
     return features_per_bp
 
 def parse_dict_to_df(datas:Dict, fields:List[Union[str, Tuple[str]]]) -> pd.DataFrame:
@@ -41,25 +166,29 @@ def parse_dict_to_df(datas:Dict, fields:List[Union[str, Tuple[str]]]) -> pd.Data
     
     def _get_from_jsonlike(jsonlike:Union[str, dict], key:str):
         if not isinstance(jsonlike, dict):
-            jsonlike = json.loads(jsonlike)
+            jsonlike = json_loads(jsonlike)
         return jsonlike[key]
     
+    # Parse every record of a source once, however many fields are read from it.
+    parsed_sources = {}
+    for field in fields:
+        if isinstance(field, tuple) and field[0] not in parsed_sources:
+            parsed_sources[field[0]] = [
+                jsonlike if isinstance(jsonlike, dict) else json_loads(jsonlike)
+                for jsonlike in datas[field[0]]
+            ]
+
     for field in fields:
         if isinstance(field, str):
-            col = []
-            
-            for record in datas[field]:
-                col.append(record)
-            dict_for_df[field] = col
+            dict_for_df[field] = list(datas[field])
 
         elif isinstance(field, tuple):
             col = []
 
-            for jsonlike in datas[field[0]]:
+            for jsonlike in parsed_sources[field[0]]:
                 for key in field[1:]:
                     jsonlike = _get_from_jsonlike(jsonlike, key)
-                record = jsonlike
-                col.append(record)
+                col.append(jsonlike)
             dict_for_df[field[-1]] = col
 
     return pd.DataFrame(dict_for_df)
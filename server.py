@@ -0,0 +1,113 @@
+import os
+import json
+from uuid import uuid4
+from typing import List, Optional
+from contextlib import asynccontextmanager
+
+from dotenv import load_dotenv
+from fastapi import FastAPI, HTTPException
+from fastapi.responses import StreamingResponse
+from pydantic import BaseModel
+
+from chain.chat import ChatManager
+from chain.llm import ResilientStream
+
+load_dotenv()
+
+# One ChatManager per process: Chroma client, embedding client and LLM client are shared by every session.
+CHAT_MANAGER = None
+
+class QueryRequest(BaseModel):
+    text: str
+    base64_image: Optional[str] = None
+    session_id: Optional[str] = None
+
+class DocsRequest(BaseModel):
+    ids: List[str]
+
+def get_chat_manager() -> ChatManager:
+    if CHAT_MANAGER is None:
+        raise HTTPException(status_code=503, detail="ChatManager is not ready.")
+    return CHAT_MANAGER
+
+@asynccontextmanager
+async def lifespan(app:FastAPI):
+    global CHAT_MANAGER
+    CHAT_MANAGER = ChatManager(
+        llm_type=os.getenv("LLM_TYPE", "google"),
+        model_name=os.getenv("MODEL_NAME") or None,
+        retry_count=int(os.getenv("RETRY_COUNT", 3)),
+        retriver_doc_num=10,
+        fallback_llm_type=os.getenv("FALLBACK_LLM_TYPE") or None,
+        fallback_model_name=os.getenv("FALLBACK_MODEL_NAME") or None,
+        image_index_path=os.getenv("BLUEPRINT_INDEX_PATH", "./chroma/blueprint_index.npz"),
+    )
+    yield
+    CHAT_MANAGER = None
+
+app = FastAPI(title="PartFinder AI", lifespan=lifespan)
+
+def _sse(event:str, data) -> str:
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+@app.get("/health")
+async def health():
+    return {"status": "ok" if CHAT_MANAGER is not None else "starting"}
+
+@app.post("/query")
+async def query(request:QueryRequest):
+    chat_manager = get_chat_manager()
+    session_id = request.session_id or str(uuid4())
+    answer = await chat_manager.aquery(
+        text=request.text,
+        base64_image=request.base64_image,
+        session_id=session_id
+    )
+    return {
+        "session_id": session_id,
+        "answer": answer,
+        "context_ids": await chat_manager.aget_context(session_id),
+    }
+
+@app.post("/query/stream")
+async def query_stream(request:QueryRequest):
+    chat_manager = get_chat_manager()
+    session_id = request.session_id or str(uuid4())
+
+    async def _events():
+        yield _sse("session", {"session_id": session_id})
+        try:
+            async for chunk in chat_manager.aquery_stream(
+                text=request.text,
+                base64_image=request.base64_image,
+                session_id=session_id
+            ):
+                if chunk == ResilientStream.RESTART_NOTICE:
+                    # The answer starts over; clients drop what they have shown so far.
+                    yield _sse("restart", {})
+                    continue
+                yield _sse("answer", chunk)
+        except Exception as e:
+            yield _sse("error", {"type": type(e).__name__, "message": str(e)})
+            return
+        yield _sse("context", {"context_ids": await chat_manager.aget_context(session_id)})
+        yield _sse("done", {})
+
+    return StreamingResponse(
+        _events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+@app.post("/documents")
+def documents(request:DocsRequest):
+    return get_chat_manager().get_docs_from_ids(request.ids)
+
+if __name__ == "__main__":
+    import uvicorn
+
+    uvicorn.run(
+        app,
+        host=os.getenv("SERVER_HOST", "0.0.0.0"),
+        port=int(os.getenv("SERVER_PORT", 8000))
+    )
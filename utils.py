@@ -1,27 +1,160 @@
 from typing import ByteString
+import os
+import json
 import base64
+import hashlib
+import threading
+from collections import OrderedDict
 from io import BytesIO
-from typing import Literal
+from typing import Literal, Union
 from PIL import Image
 
-def pil_to_b64(img):
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+def json_loads(text:Union[str, bytes]):
+    # Only parsing uses orjson: stored text is always written by json.dumps so it does not
+    # depend on which backend is installed. NaN/Infinity are only accepted by the stdlib.
+    if orjson is not None:
+        try:
+            return orjson.loads(text)
+        except orjson.JSONDecodeError:
+            pass
+    return json.loads(text)
+
+def estimate_tokens(text:str) -> int:
+    # ~4 characters per token is close enough for budgeting across providers.
+    return len(text) // 4 + 1
+
+class ImageCache:
+    """Size-bounded LRU of decoded/re-encoded image variants keyed by file content hash."""
+
+    def __init__(self, max_bytes:int = 64 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()  # (digest, variant) -> (value, size)
+        self._size = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def estimate_size(value) -> int:
+        if isinstance(value, Image.Image):
+            return value.width * value.height * len(value.getbands())
+        return len(value)
+
+    def get(self, key):
+        with self._lock:
+            if key not in self._entries:
+                return None
+            self._entries.move_to_end(key)
+            return self._entries[key][0]
+
+    def put(self, key, value):
+        size = self.estimate_size(value)
+        with self._lock:
+            if key in self._entries:
+                self._size -= self._entries.pop(key)[1]
+            self._entries[key] = (value, size)
+            self._size += size
+            while self._size > self.max_bytes and len(self._entries) > 1:
+                self._size -= self._entries.popitem(last=False)[1][1]
+
+# Built on first use so IMAGE_CACHE_MAX_BYTES from a .env loaded after import is honored.
+_IMAGE_CACHE = None
+_IMAGE_CACHE_LOCK = threading.Lock()
+
+def get_image_cache() -> ImageCache:
+    global _IMAGE_CACHE
+    with _IMAGE_CACHE_LOCK:
+        if _IMAGE_CACHE is None:
+            _IMAGE_CACHE = ImageCache(max_bytes=int(os.environ.get("IMAGE_CACHE_MAX_BYTES", 64 * 1024 * 1024)))
+        return _IMAGE_CACHE
+
+_PATH_DIGESTS = {}  # path -> (mtime_ns, size, digest), skips re-hashing unchanged files
+
+def get_image_options():
+    # Max edge 0 keeps the original resolution.
+    return int(os.environ.get("IMAGE_MAX_EDGE", 1568)), int(os.environ.get("IMAGE_JPEG_QUALITY", 85))
+
+def _digest_file(path:str):
+    stat = os.stat(path)
+    cached = _PATH_DIGESTS.get(path)
+    if cached is not None and cached[:2] == (stat.st_mtime_ns, stat.st_size):
+        return cached[2], None
+    with open(path, "rb") as f:
+        file_bytes = f.read()
+    digest = hashlib.sha256(file_bytes).hexdigest()
+    _PATH_DIGESTS[path] = (stat.st_mtime_ns, stat.st_size, digest)
+    return digest, file_bytes
+
+def preprocess_image(img, max_edge:int = None):
+    img = img.convert("RGB")
+    if max_edge and max(img.size) > max_edge:
+        img = img.copy()
+        img.thumbnail((max_edge, max_edge), Image.LANCZOS)
+    return img
+
+def pil_to_b64(img, max_edge:int = None, quality:int = 75):
     buffer = BytesIO()
-    img=img.convert("RGB")
-    img.save(buffer, format="jpeg")
+    img = preprocess_image(img, max_edge=max_edge)
+    img.save(buffer, format="jpeg", quality=quality)
     base64_image = base64.b64encode(buffer.getvalue()).decode("utf-8")
     return base64_image
 
 def byte_to_b64(file_bytes:ByteString):
     return base64.b64encode(file_bytes).decode()
 
-def open_img(path: str, mode: Literal["pil", "b64", "bytes"] = "pil"):
+def shrink_b64_image(base64_image:str) -> str:
+    """Downscale and re-encode an uploaded base64 image before it is sent to the LLM."""
+    max_edge, quality = get_image_options()
+    key = (hashlib.sha256(base64_image.encode("utf-8")).hexdigest(), "b64", max_edge, quality)
+    cached = get_image_cache().get(key)
+    if cached is not None:
+        return cached
+    try:
+        pil_image = Image.open(BytesIO(base64.b64decode(base64_image)))
+        shrunk = pil_to_b64(pil_image, max_edge=max_edge, quality=quality)
+    except Exception:
+        return base64_image
+    # Keep the upload when re-encoding would not make it smaller.
+    result = shrunk if len(shrunk) < len(base64_image) else base64_image
+    get_image_cache().put(key, result)
+    return result
+
+def open_img(
+    path: str,
+    mode: Literal["pil", "b64", "bytes"] = "pil",
+    max_edge: int = None,
+    quality: int = None
+):
+    digest, file_bytes = _digest_file(path)
+
+    if mode == "b64":
+        default_max_edge, default_quality = get_image_options()
+        max_edge = default_max_edge if max_edge is None else max_edge
+        quality = default_quality if quality is None else quality
+        key = (digest, mode, max_edge, quality)
+    else:
+        key = (digest, mode)
+
+    cached = get_image_cache().get(key)
+    if cached is not None:
+        return cached.copy() if mode == "pil" else cached
+
+    if mode == "bytes" and file_bytes is not None:
+        # The file content already is the encoded image.
+        get_image_cache().put(key, file_bytes)
+        return file_bytes
+
     pil_image = Image.open(path)
-    
     if mode == "b64":
-        return pil_to_b64(pil_image)
+        value = pil_to_b64(pil_image, max_edge=max_edge, quality=quality)
     elif mode == "bytes":
-        img_byte_arr = BytesIO()
-        pil_image.save(img_byte_arr, format=pil_image.format)
-        return img_byte_arr.getvalue()
+        with open(path, "rb") as f:
+            value = f.read()
     else:
-        return pil_image
\ No newline at end of file
+        pil_image.load()
+        value = pil_image
+    get_image_cache().put(key, value)
+    return value.copy() if mode == "pil" else value